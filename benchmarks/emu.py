@@ -0,0 +1,99 @@
+"""
+Measure how many instructions per second the emulator runs, on a few loops
+with different instruction mixes, writing the results as JSON.
+
+	python benchmarks/emu.py -o emu.json
+
+Rates are the best of several runs, each of a fixed number of instructions.
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src")) # allow running in-tree
+
+import argparse
+import json
+import platform
+import time
+
+from p65a import *
+from p65a.emu import CPU
+
+
+def tight():
+	"""Count X down over and over: just DEX and a taken branch"""
+	return [lbl.loop, DEX(), BNE(lbl.loop), JMP(lbl.loop)]
+
+
+def copy():
+	"""Copy a page with absolute indexed loads and stores"""
+	return [
+		lbl.loop, LDX(0),
+		lbl.copy_loop, LDA(Addr(0x2000)[X]), STA(Addr(0x3000)[X]), INX(), BNE(lbl.copy_loop),
+		JMP(lbl.loop),
+	]
+
+
+def arith():
+	"""16-bit additions and shifts on zero-page variables, and a subroutine call"""
+	return [
+		lbl.loop, JSR(lbl.add16), ASL(zp.v), ROL(zp.v + 1), JMP(lbl.loop),
+		lbl.add16, CLC(), LDA(zp.v), ADC(zp.w), STA(zp.v), LDA(zp.v + 1), ADC(zp.w + 1), STA(zp.v + 1), RTS(),
+	]
+
+
+WORKLOADS = {"tight": tight, "copy": copy, "arith": arith}
+
+
+def benchmark(name, program, instructions, repeat):
+	prog, labels = concretise([Org(0x10), zp.v, Db([1, 0]), zp.w, Db([3, 0]), Org(0x1000), program()])
+	image = assemble(prog, labels)
+	best = float("inf")
+	for _ in range(repeat):
+		cpu = CPU()
+		cpu.load(image)
+		cpu.pc = labels["loop"]
+		start = time.perf_counter()
+		cycles = cpu.run(max_instructions=instructions)
+		best = min(best, time.perf_counter() - start)
+	return {
+		"workload": name,
+		"instructions": instructions,
+		"seconds": best,
+		"instructions_per_second": instructions / best,
+		"cycles_per_second": cycles / best,
+	}
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument("-o", "--output", help="write the results to this JSON file")
+	parser.add_argument("--instructions", type=int, default=1000000,
+		help="instructions per run (default: %(default)s)")
+	parser.add_argument("--workloads", default=",".join(WORKLOADS),
+		help="comma-separated workloads (default: %(default)s)")
+	parser.add_argument("--repeat", type=int, default=3, help="runs per workload (default: %(default)s)")
+	args = parser.parse_args()
+
+	results = []
+	for name in args.workloads.split(","):
+		result = benchmark(name, WORKLOADS[name], args.instructions, args.repeat)
+		results.append(result)
+		print(f"{name:>8}: {result['instructions_per_second'] / 1e3:8.0f}K instructions/s, {result['cycles_per_second'] / 1e6:.2f}MHz", file=sys.stderr)
+
+	output = {
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+		"results": results,
+	}
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(output, f, indent="\t")
+	else:
+		json.dump(output, sys.stdout, indent="\t")
+		print()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,131 @@
+"""
+Time rebuilds with an incremental Session against from-scratch builds, on a
+program of several sections that call each other, writing the results as
+JSON.
+
+	python benchmarks/incremental.py -o incremental.json
+
+Each rebuild is timed with the sections that didn't change passed in again
+as the same objects (as a caller that keeps them would), and with the whole
+program generated afresh, both with and without a key for each section (as
+a caller that knows which source each came from could pass). Generating the
+program isn't timed. Times are the best of several runs.
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src")) # allow running in-tree
+
+import argparse
+import json
+import platform
+import random
+import time
+
+from p65a import *
+from p65a.incremental import Session
+from p65a.symbolics import Symbol
+
+from programs import ZP_VARS, zp_vars
+
+
+def section(index, sections, size, extra=0):
+	"""Typical code at its own Org, calling routines in the other sections"""
+	rng = random.Random(index)
+	label = lambda name: Symbol.make(f"b{index}_{name}", type=Addr)
+	out = [Org(0x1000 + index * 0x2000)]
+	routines = 0
+	for i in range(size):
+		v = getattr(zp, f"v{rng.randrange(ZP_VARS)}")
+		if i % 8 == 0:
+			out.append(label(f"r{routines}"))
+			routines += 1
+			continue
+		match rng.randrange(8):
+			case 0: out.append(A <= v)
+			case 1: out.append(v <= A)
+			case 2: out.append(A <= A + v)
+			case 3: out.append(BNE(label(f"r{routines - 1}")))
+			case 4: out.append(JSR(Symbol.make(f"b{rng.randrange(sections)}_r0", type=Addr)))
+			case 5: out.append(JSR(label(f"r{rng.randrange(routines)}")))
+			case 6: out.append(INC(X))
+			case 7: out.append(RTS())
+	return out + [NOP()] * extra
+
+
+def program(sections, size, edited=None):
+	"""The program, with a NOP appended to section `edited`"""
+	return [zp_vars()] + [section(i, sections, size, i == edited) for i in range(sections)]
+
+
+def keys(sections, edited=None):
+	"""A key for each section of program(sections, ...): its index, and
+	whether it was edited"""
+	return ["zp"] + [(i, i == edited) for i in range(sections)]
+
+
+def best(repeat, setup, step):
+	times = []
+	for _ in range(repeat):
+		state = setup()
+		start = time.perf_counter()
+		step(state)
+		times.append(time.perf_counter() - start)
+	return min(times)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument("-o", "--output", help="write the results to this JSON file")
+	parser.add_argument("--sections", type=int, default=6, help="number of sections (default: %(default)s)")
+	parser.add_argument("--size", type=int, default=3000, help="instructions per section (default: %(default)s)")
+	parser.add_argument("--repeat", type=int, default=5, help="runs per measurement (default: %(default)s)")
+	args = parser.parse_args()
+
+	n = args.sections
+	original = program(n, args.size)
+	edited = original[:]
+	edited[2] = section(1, n, args.size, 1)  # the same as program(n, args.size, 1)
+
+	def session(rebuild, edited=None, keyed=False):
+		def setup():
+			s = Session()
+			s.assemble(original, keys(n) if keyed else None)
+			return s, rebuild(), keys(n, edited) if keyed else None
+		return setup
+
+	def rebuild(state):
+		s, prog, keys = state
+		s.assemble(prog, keys)
+
+	timings = {
+		"scratch": best(args.repeat, lambda: program(n, args.size), lambda prog: assemble(*concretise(prog))),
+		"first build": best(args.repeat, lambda: program(n, args.size), lambda prog: Session().assemble(prog)),
+		"unchanged, same objects": best(args.repeat, session(lambda: original), rebuild),
+		"unchanged, regenerated": best(args.repeat, session(lambda: program(n, args.size)), rebuild),
+		"one NOP added, same objects": best(args.repeat, session(lambda: edited), rebuild),
+		"one NOP added, regenerated": best(args.repeat, session(lambda: program(n, args.size, 1)), rebuild),
+		"unchanged, regenerated with keys": best(args.repeat, session(lambda: program(n, args.size), keyed=True), rebuild),
+		"one NOP added, regenerated with keys": best(args.repeat, session(lambda: program(n, args.size, 1), 1, True), rebuild),
+	}
+	for name, seconds in timings.items():
+		print(f"{name:>36}: {seconds:.4f}s ({timings['scratch'] / seconds:.1f}x)", file=sys.stderr)
+
+	output = {
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+		"sections": n,
+		"size": args.size,
+		"seconds": timings,
+	}
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(output, f, indent="\t")
+	else:
+		json.dump(output, sys.stdout, indent="\t")
+		print()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,132 @@
+"""
+Synthetic program generators, for benchmarking.
+
+Each generator takes a number of instructions (roughly: data directives and
+labels count as one each) and returns a program. Programs bigger than a
+single address space are split into sections that all sit at the same Org,
+like banks of a cartridge, each with its own labels, so they can still be
+laid out and assembled. Generation is deterministic, so every run of a
+benchmark assembles exactly the same program.
+"""
+
+import os
+import importlib.util
+import random
+
+from p65a import *
+from p65a.symbolics import Symbol
+
+SECTION_ORG = 0x4000
+ZP_VARS = 16
+
+
+def label(section, name):
+	return Symbol.make(f"s{section}_{name}", type=Addr)
+
+
+def zp_vars():
+	"""A zero-page section defining the variables everything uses"""
+	return [Org(0)] + [[getattr(zp, f"v{i}"), Db([0, 0])] for i in range(ZP_VARS)]
+
+
+def sectioned(n, per_section, body):
+	"""Build a program of n instructions from `body(section, rng, count)`,
+	which should return a list of `count` of them"""
+	rng = random.Random(n)
+	program = [zp_vars()]
+	for section, start in enumerate(range(0, n, per_section)):
+		program += [Org(SECTION_ORG), body(section, rng, min(per_section, n - start))]
+	return program
+
+
+def mixed(n):
+	"""Typical code: loads and stores, short loops, and subroutine calls"""
+	def body(section, rng, count):
+		out = []
+		routines = 0
+		for i in range(count):
+			v = getattr(zp, f"v{rng.randrange(ZP_VARS)}")
+			if i % 8 == 0:
+				out.append(label(section, f"r{routines}"))
+				routines += 1
+				continue
+			match rng.randrange(10):
+				case 0: out.append(A <= v)
+				case 1: out.append(v <= A)
+				case 2: out.append(A <= rng.randrange(0x100))
+				case 3: out.append(A <= A + v)
+				case 4: out.append(A <= label(section, "table")[X])
+				case 5: out.append(INC(X))
+				case 6: out.append(BNE(label(section, f"r{routines - 1}")))
+				case 7: out.append(label(section, f"r{rng.randrange(routines)}")())
+				case 8: out.append(A == v)
+				case 9: out.append(RTS())
+		return out + [label(section, "table"), Db(bytes(range(256)))]
+	return sectioned(n, 8000, body)
+
+
+def labels(n):
+	"""Every other item is a label, and every instruction is a branch or jump
+	to one, forwards and backwards, with some of them out of range"""
+	def body(section, rng, count):
+		out = []
+		for i in range(0, count, 2):
+			out.append(label(section, f"l{i}"))
+			target = rng.randrange(max(0, i - 200), min(count, i + 200)) & ~1
+			out.append(rng.choice((BEQ, BNE, BCC, JMP))(label(section, f"l{target}")))
+		return out
+	return sectioned(n, 12000, body)
+
+
+def data(n):
+	"""Mostly data tables, of bytes and words, some of them pointers"""
+	def body(section, rng, count):
+		tables = [label(section, "t")]
+		out = tables[:]
+		for i in range(count - 1):
+			match rng.randrange(4):
+				case 0:
+					tables.append(label(section, f"t{i}"))
+					out.append(tables[-1])
+				case 1: out.append(Db(rng.randbytes(rng.randrange(1, 32))))
+				case 2: out.append(Dw([rng.randrange(0x10000) for _ in range(rng.randrange(1, 16))]))
+				case 3: out.append(Dw([rng.choice(tables) for _ in range(4)]))
+		return out
+	return sectioned(n, 1500, body)
+
+
+def exprs(n):
+	"""Operands are arithmetic on labels, rather than plain labels"""
+	def body(section, rng, count):
+		out = []
+		for i in range(count):
+			if i % 4 == 0:
+				out.append(label(section, f"e{i}"))
+				continue
+			base = label(section, f"e{rng.randrange(0, count, 4)}")
+			other = label(section, f"e{rng.randrange(0, count, 4)}")
+			match rng.randrange(4):
+				case 0: out.append(A <= (base + rng.randrange(64))[X])
+				case 1: out.append(STA(Addr(base + (other - base >> 1) + i % 7)))
+				case 2: out.append(LDX(lo(base + 3 * (i & 15))))
+				case 3: out.append(LDY(hi(other - 1)))
+		return out
+	return sectioned(n, 10000, body)
+
+
+def bootloader(n=None):
+	"""The bootloader example, which is the same size whatever `n` is. Raises
+	ImportError if its dependencies aren't installed."""
+	path = os.path.join(os.path.dirname(__file__), "..", "examples", "bootloader.py")
+	spec = importlib.util.spec_from_file_location("bootloader", path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module.program
+
+
+GENERATORS = {
+	"mixed": mixed,
+	"labels": labels,
+	"data": data,
+	"exprs": exprs,
+}
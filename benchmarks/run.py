@@ -0,0 +1,179 @@
+"""
+Benchmark each phase of the assembler on synthetic programs of various sizes,
+plus the bootloader example, writing the results as JSON.
+
+	python benchmarks/run.py -o before.json
+	(make some changes)
+	python benchmarks/run.py -o after.json --compare before.json
+
+Wall times are the best of several runs. Peak memory is measured separately,
+with tracemalloc (which slows everything down), as the most memory allocated
+at once during a phase, on top of what was already allocated before it. The
+counters from another, instrumented, run are included too.
+
+The default sizes go up to a million instructions, which takes over an hour
+(nearly all of it in the million-instruction runs) and a few hundred MiB.
+Pass e.g. --sizes 1000,10000,100000 for a run that takes a few minutes.
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src")) # allow running in-tree
+
+import argparse
+import gc
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+from p65a import *
+from p65a.assembler import split_sections
+from p65a.instrument import Instrumentation
+
+from programs import GENERATORS, bootloader
+
+PHASES = ["build", "flatten", "concretise", "assemble", "listing"]
+
+# timings shorter than this are too noisy to count as regressions
+NOISE_FLOOR = 0.01
+
+
+def run_phases(generate, size, measure, instrument=None):
+	"""Run each phase in turn, returning ({phase: measure(step)}, the number
+	of instructions)"""
+	state = {}
+	steps = {
+		"build": lambda: state.update(program=generate(size)),
+		"flatten": lambda: state.update(flat=list(flatten(state["program"]))),
+		"concretise": lambda: state.update(zip(("prog", "labels"), concretise(state["flat"], instrument=instrument))),
+		# each section is assembled separately, since big programs have
+		# several of them at the same address
+		"assemble": lambda: [assemble(section, state["labels"], instrument) for section in split_sections(state["prog"])],
+		"listing": lambda: make_listing(state["prog"], state["labels"], instrument=instrument),
+	}
+	measurements = {phase: measure(steps[phase]) for phase in PHASES}
+	return measurements, len(state["flat"])
+
+
+def wall_time(step):
+	gc.collect()
+	start = time.perf_counter()
+	step()
+	return time.perf_counter() - start
+
+
+def peak_memory(step):
+	gc.collect()
+	tracemalloc.reset_peak()
+	before = tracemalloc.get_traced_memory()[0]
+	step()
+	return tracemalloc.get_traced_memory()[1] - before
+
+
+def benchmark(name, generate, size, repeat):
+	runs = [run_phases(generate, size, wall_time) for _ in range(repeat)]
+	tracemalloc.start()
+	try:
+		peaks, count = run_phases(generate, size, peak_memory)
+	finally:
+		tracemalloc.stop()
+	instrument = Instrumentation()
+	run_phases(generate, size, lambda step: step(), instrument)
+	return {
+		"program": name,
+		"size": size,
+		"instructions": count,
+		"seconds": {phase: min(times[phase] for times, _ in runs) for phase in PHASES},
+		"peak_bytes": peaks,
+		"counters": instrument.counters,
+	}
+
+
+def git_revision():
+	try:
+		return subprocess.run(
+			["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+			cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+		).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def compare(old, new, threshold):
+	"""Print the change in each measurement, and return the regressions"""
+	previous = {(r["program"], r["size"]): r for r in old["results"]}
+	regressions = []
+	for result in new["results"]:
+		key = (result["program"], result["size"])
+		if key not in previous:
+			continue
+		for metric in ("seconds", "peak_bytes"):
+			for phase, value in result[metric].items():
+				before = previous[key][metric].get(phase)
+				if not before:
+					continue
+				ratio = value / before
+				flag = ""
+				if ratio > threshold and (metric != "seconds" or value > NOISE_FLOOR):
+					flag = "  <-- slower" if metric == "seconds" else "  <-- bigger"
+					regressions.append((key, metric, phase, ratio))
+				print(f"{key[0]:>10} {key[1] or '':>8} {phase:>10} {metric:>10}: {before:12.4g} -> {value:12.4g} ({ratio:.2f}x){flag}")
+	return regressions
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument("-o", "--output", help="write the results to this JSON file")
+	parser.add_argument("--sizes", default="1000,10000,100000,1000000",
+		help="comma-separated instruction counts (default: %(default)s)")
+	parser.add_argument("--programs", default=",".join(list(GENERATORS) + ["bootloader"]),
+		help="comma-separated program kinds (default: %(default)s)")
+	parser.add_argument("--repeat", type=int, default=3, help="timing runs per benchmark (default: %(default)s)")
+	parser.add_argument("--compare", metavar="JSON", help="compare with the results from an earlier run")
+	parser.add_argument("--threshold", type=float, default=1.2,
+		help="with --compare, exit with an error if anything got this many times worse (default: %(default)s)")
+	args = parser.parse_args()
+
+	sizes = [int(size) for size in args.sizes.split(",")]
+	results = []
+	for name in args.programs.split(","):
+		if name == "bootloader":
+			try:
+				bootloader()
+			except ImportError as e:
+				print(f"skipping bootloader: {e}", file=sys.stderr)
+				continue
+			runs = [(bootloader, None)]
+		else:
+			runs = [(GENERATORS[name], size) for size in sizes]
+		for generate, size in runs:
+			result = benchmark(name, generate, size, args.repeat)
+			results.append(result)
+			times = " ".join(f"{phase} {seconds:.4f}s" for phase, seconds in result["seconds"].items())
+			print(f"{name:>10} {size or '':>8}: {result['instructions']} instructions, {times}, peak {max(result['peak_bytes'].values()) / 2**20:.1f}MiB", file=sys.stderr)
+
+	output = {
+		"revision": git_revision(),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+		"results": results,
+	}
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(output, f, indent="\t")
+	else:
+		json.dump(output, sys.stdout, indent="\t")
+		print()
+
+	if args.compare:
+		with open(args.compare) as f:
+			regressions = compare(json.load(f), output, args.threshold)
+		if regressions:
+			sys.exit(f"{len(regressions)} measurement(s) regressed by more than {args.threshold}x")
+
+
+if __name__ == "__main__":
+	main()
@@ -71,7 +71,7 @@ program = [
 		lbl.putchar(),
 		RTS(),
 
-	# TODO: alignment
+	Align(0x100),
 	lbl.CRC_LUT_HI,
 		Db([crc16(bytes([i])) >> 8 for i in range(0x100)]),
 	lbl.CRC_LUT_LO,
@@ -146,13 +146,10 @@ program = [
 
 
 	lbl.handle_cmd,
-		A <= 0,
-		A == zp.cmd,
-		BEQ(lbl.handle_cmd_write),
-
-		A <= 1,
-		A == zp.cmd,
-		BEQ(lbl.handle_cmd_exec),
+		Switch(zp.cmd, {
+			0: lbl.handle_cmd_write,
+			1: lbl.handle_cmd_exec,
+		}, name="cmd_switch"),
 
 		# fallthru
 	lbl.badcmd,
@@ -219,9 +216,9 @@ program = [
 ]
 
 
-concrete_prog, labels = concretise(program)
-out = assemble(concrete_prog, labels)
-rom = out[0xc000:]
-open("rom.bin", "wb").write(rom)
+if __name__ == "__main__":
+	concrete_prog, labels = concretise(program)
+	with open("rom.bin", "wb") as f, BinWriter(f, start=0xc000, end=0x10000) as rom:
+		rom.write_program(concrete_prog, labels)
 
-print(make_listing(concrete_prog, labels))
+	print(make_listing(concrete_prog, labels))
@@ -1 +1,2 @@
 from .assembler import *
+from .output import *
@@ -1,6 +1,20 @@
+import hashlib
+import mmap
+import os
+import sys
+from array import array
 from copy import copy
 from enum import Enum
-from .symbolics import Expression, SymbolFactory, Symbol, Literal
+from collections.abc import Iterator
+from contextlib import nullcontext
+from .symbolics import Expression, SymbolFactory, Symbol, Literal, SymbolTable, lo, hi, bank
+from .image import Image
+from .instrument import operand_count
+
+try:
+	import numpy
+except ImportError:
+	numpy = None  # optional, for faster encoding of big data tables
 
 
 class Mode(Enum):
@@ -36,6 +50,30 @@ mode_lengths = {
 }
 
 
+# zero-page equivalents of absolute modes, for when the operand turns out to fit
+zp_modes = {
+	Mode.ABS:  Mode.ZPG,
+	Mode.ABSX: Mode.ZPGX,
+	Mode.ABSY: Mode.ZPGY,
+}
+
+abs_modes = {v: k for k, v in zp_modes.items()}
+
+
+def operand_key(oper):
+	"""A hashable key identifying an operand, for comparing them structurally"""
+	if oper is None or type(oper) is int:
+		return oper
+	if isinstance(oper, Register):
+		return type(oper).__name__  # registers overload ==, so aren't hashable
+	addr = getattr(oper, "addr", oper)
+	if isinstance(addr, Expression):
+		addr = addr.key()
+	elif isinstance(addr, list):  # an indirect operand that hasn't been unwrapped
+		return ("ind",) + tuple(operand_key(x) for x in addr)
+	return type(oper).__name__, addr, type(getattr(oper, "index", None)).__name__
+
+
 class Register:
 	pass
 
@@ -108,6 +146,8 @@ X = Xreg()
 Y = Yreg()
 
 class Address:
+	__slots__ = ("addr",)
+
 	def __init__(self, addr):
 		self.addr = addr
 	
@@ -128,6 +168,8 @@ class Address:
 			raise Exception("I dunno how to store that")
 
 class ZP(Address):
+	__slots__ = ()
+
 	def __getitem__(self, item):
 		if item == 0:
 			return ZPindY_partial(self.addr)
@@ -136,6 +178,8 @@ class ZP(Address):
 		return ZPIndex(self.addr, item)
 
 class ZPIndex(Address):
+	__slots__ = ("index",)
+
 	def __init__(self, addr, index):
 		self.addr = addr
 		self.index = index
@@ -146,19 +190,23 @@ class ZPIndex(Address):
 		raise Exception("too much indirection")
 
 class ZPXind(ZPIndex):
-	pass
+	__slots__ = ()
 
 class ZPindY_partial(Address):
+	__slots__ = ()
+
 	def __getitem__(self, item):
 		if isinstance(item, Yreg):
 			return ZPindY(self.addr, item)
 
 class ZPindY(ZPIndex):
-	pass
+	__slots__ = ()
 
 
 
 class Addr(Address):
+	__slots__ = ()
+
 	def __getitem__(self, item):
 		if not isinstance(item, (Xreg, Yreg)):
 			raise Exception(f"Addr can't be indexed by {item}")
@@ -169,35 +217,200 @@ class Addr(Address):
 
 
 class AddrIndex(Address):
+	__slots__ = ("index",)
+
 	def __init__(self, addr, index):
 		self.addr = addr
 		self.index = index
 
-class Instruction:
+# Encoders for each addressing mode. An instruction picks its encoder when
+# its mode is set, so assembling it is just a call, with no dispatch on mode.
+
+def encode_implied(instr, labels):
+	return instr.encoding
+
+def encode_word(instr, labels):
+	addr = instr.oper.addr
+	if type(addr) is not int:
+		addr = addr.evaluate(labels)
+	return instr.encoding + addr.to_bytes(2, "little")
+
+def encode_byte(instr, labels):
+	addr = instr.oper.addr
+	if type(addr) is not int:
+		addr = addr.evaluate(labels)
+	return instr.encoding + addr.to_bytes(1, "little")
+
+def encode_immediate(instr, labels):
+	value = instr.oper
+	if type(value) is not int:
+		value = value.evaluate(labels)
+		if not 0 <= value < 0x100:
+			raise Exception(f"Immediate argument is out of range: {value}")
+	return instr.encoding + value.to_bytes(1, "little")
+
+def encode_relative(instr, labels):
+	target = instr.oper.get_concrete_addr(labels)
+	if instr.far:
+		# flipping bit 5 of a branch opcode inverts its condition
+		return bytes([instr.encoding[0] ^ 0x20, 3, JMP.modes[Mode.ABS]]) + target.to_bytes(2, "little")
+	return instr.encoding + (target - 2 - instr.address).to_bytes(1, "little", signed=True)
+
+mode_encoders = {
+	Mode.A:    encode_implied,
+	Mode.IMPL: encode_implied,
+	Mode.ABS:  encode_word,
+	Mode.ABSX: encode_word,
+	Mode.ABSY: encode_word,
+	Mode.IND:  encode_word,
+	Mode.ZPG:  encode_byte,
+	Mode.ZPGX: encode_byte,
+	Mode.ZPGY: encode_byte,
+	Mode.XIND: encode_byte,
+	Mode.INDY: encode_byte,
+	Mode.IMM:  encode_immediate,
+	Mode.REL:  encode_relative,
+}
+
+# the addressing mode implied by each type of operand, where the type alone
+# (or with the type of its index register) is enough to tell
+operand_modes = {
+	type(None):        Mode.IMPL,
+	int:               Mode.IMM,
+	Areg:              Mode.A,
+	Addr:              Mode.ABS,
+	(AddrIndex, Xreg): Mode.ABSX,
+	(AddrIndex, Yreg): Mode.ABSY,
+	ZP:                Mode.ZPG,
+	(ZPIndex, Xreg):   Mode.ZPGX,
+	(ZPIndex, Yreg):   Mode.ZPGY,
+	ZPXind:            Mode.XIND,
+	ZPindY:            Mode.INDY,
+}
+
+
+class InstructionType(type):
+	"""Gives every Instruction subclass that doesn't declare its own
+	__slots__ an empty one, so that none of the opcode classes below end up
+	with a per-instance __dict__. Also records every slot a class has, in
+	`fields`, for copying, and precomputes the (encoding, length, encoder)
+	of each mode, so that setting an instruction's mode is a single lookup."""
+	def __new__(mcls, name, bases, namespace):
+		namespace.setdefault("__slots__", ())
+		cls = super().__new__(mcls, name, bases, namespace)
+		cls.fields = tuple(name for c in reversed(cls.__mro__) for name in c.__dict__.get("__slots__", ()))
+		cls.forms = {
+			mode: (bytes([opcode]), mode_lengths[mode], mode_encoders[mode])
+			for mode, opcode in cls.modes.items()
+		}
+		cls.relative = Mode.REL in cls.modes
+		return cls
+
+
+class Instruction(metaclass=InstructionType):
+	__slots__ = ("oper", "mode", "length", "encoding", "encoder", "address", "far")
 	modes = {}
-	address = None
-	length = None
+	cycles = {}  # base cycle count for each mode
+	page_penalty = False  # +1 cycle when indexing crosses a page (reads only)
+	padding = False  # if True, layout() calls pad_length() to size it at each address
 
 	def __init__(self, oper=None):
-		if isinstance(oper, Expression):
-			oper = oper.type(oper)
+		self.address = None
+		self.far = False  # set on branches that had to be expanded, see relax()
+		if isinstance(oper, Expression) and oper.type is not None:
+			oper = oper.type(oper)  # untyped ones are immediates
 		
 		# jank for indirect jmps
 		if type(oper) is list and len(oper) == 1 and isinstance(oper[0], Expression):
 			oper = [oper[0].type(oper[0])]
 		
 		self.oper = oper
-		self.mode = self.determine_mode(oper)
-		if self.mode == Mode.ABS and Mode.REL in self.modes:
-			self.mode = Mode.REL
-		if self.mode == Mode.IND:
+		mode = self.determine_mode(oper)
+		if mode is Mode.ABS and self.relative:
+			mode = Mode.REL
+		if mode is Mode.IND:
 			self.oper = self.oper[0]
-		if self.mode not in self.modes:
-			raise Exception(f"Unsupported mode {self.mode} for opcode {self.__class__.__name__}")
-		self.length = mode_lengths[self.mode]
-		self.encoding = bytes([self.modes[self.mode]])
+		if mode not in self.forms:
+			raise Exception(f"Unsupported mode {mode} for opcode {self.__class__.__name__}")
+		self.set_mode(mode)
+
+	def init_pseudo(self, length, address=None):
+		"""Set up the fields of a pseudo-instruction that isn't an opcode"""
+		self.oper = None
+		self.mode = None
+		self.encoding = b""
+		self.encoder = type(self).assemble
+		self.length = length
+		self.address = address
+		self.far = False
+
+	def __copy__(self):
+		new = object.__new__(type(self))
+		for name in self.fields:
+			setattr(new, name, getattr(self, name))
+		return new
+
+	def set_mode(self, mode):
+		self.mode = mode
+		self.encoding, self.length, self.encoder = self.forms[mode]
+
+	def shrink(self, zeropage=True):
+		"""Switch to the shortest encoding this instruction could possibly
+		have, before anything is known about the layout. Returns True if the
+		choice needs to be revisited by relax() once labels are known.
+		Without `zeropage`, symbolic absolute operands are never shrunk."""
+		if self.mode == Mode.REL:
+			self.far = False
+			self.length = mode_lengths[Mode.REL]
+			return True
+		if self.mode in abs_modes and type(self.oper) in (Addr, AddrIndex):
+			self.set_mode(abs_modes[self.mode])  # shrunk in a previous layout
+		if self.mode in zp_modes and zp_modes[self.mode] in self.modes:
+			if not isinstance(self.oper.addr, Expression):
+				if self.oper.addr < 0x100:
+					self.set_mode(zp_modes[self.mode])
+				return False
+			if not zeropage:
+				return False
+			self.set_mode(zp_modes[self.mode])
+			return True
+		return False
+
+	def fits(self, labels):
+		"""Whether this instruction's shortest encoding reaches its operand
+		under the current layout (whatever its encoding is now)"""
+		try:
+			target = self.oper.get_concrete_addr(labels)
+		except KeyError:
+			return False  # undefined for now, so assume the worst
+		if self.mode == Mode.REL:
+			return -0x80 <= target - 2 - self.address < 0x80
+		return target < 0x100
+
+	def relax(self, labels):
+		"""Grow this instruction if its current encoding can't reach its
+		operand under the current layout. Returns True if it grew.
+		Instructions only ever grow, which guarantees that layout converges."""
+		if self.fits(labels):
+			return False
+		if self.mode == Mode.REL:
+			self.far = True
+			self.length = 5  # inverted branch over a JMP
+			return True
+		self.set_mode(abs_modes[self.mode])
+		return True
 	
 	def determine_mode(self, oper):
+		kind = type(oper)
+		if kind is AddrIndex or kind is ZPIndex:
+			kind = kind, type(oper.index)
+		mode = operand_modes.get(kind)
+		if mode is Mode.IMM and oper >= 0x100:
+			raise Exception(f"Immediate argument is too big: {oper}")
+		if mode is not None:
+			return mode
+
+		# anything else (ints, lists, and subclasses of the above)
 		match oper:
 			case None:
 				return Mode.IMPL
@@ -215,6 +428,8 @@ class Instruction:
 				if oper >= 0x100:
 					raise Exception(f"Immediate argument is too big: {oper}")
 				return Mode.IMM
+			case Expression(type=None):
+				return Mode.IMM  # range-checked once it's evaluated, at encode time
 			case ZPXind():
 				return Mode.XIND
 			case ZPindY():
@@ -229,20 +444,7 @@ class Instruction:
 				raise Exception(f"I don't recognise this addressing mode: {oper}")
 	
 	def assemble(self, labels={}):
-		match self.mode:
-			case Mode.A | Mode.IMPL:
-				return self.encoding
-			case Mode.ABS | Mode.ABSX | Mode.ABSY | Mode.IND:
-				return self.encoding + self.oper.get_concrete_addr(labels).to_bytes(2, "little")
-			case Mode.ZPG | Mode.ZPGX | Mode.ZPGY | Mode.XIND | Mode.INDY:
-				return self.encoding + self.oper.get_concrete_addr(labels).to_bytes(1, "little")
-			case Mode.IMM:
-				return self.encoding + self.oper.to_bytes(1, "little") # TODO: symbolic immediates?
-			case Mode.REL:
-				offset = self.oper.get_concrete_addr(labels) - 2 - self.address
-				return self.encoding + offset.to_bytes(1, "little", signed=True)
-			case _:
-				raise Exception("I dunno how to assemble that mode")
+		return self.encoder(self, labels)
 
 	def disas(self, labels={}):
 		name = self.__class__.__name__
@@ -250,6 +452,8 @@ class Instruction:
 		match self.mode:
 			case Mode.A:
 				return f"{name} A"
+			case Mode.REL if self.far:
+				return f"{inverse_branches[name]} *+5; JMP ${self.oper.get_concrete_addr(labels):04x}"
 			case Mode.ABS | Mode.REL:
 				return f"{name} ${self.oper.get_concrete_addr(labels):04x}"
 			case Mode.ABSX:
@@ -257,7 +461,8 @@ class Instruction:
 			case Mode.ABSY:
 				return f"{name} ${self.oper.get_concrete_addr(labels):04x},Y"
 			case Mode.IMM:
-				return f"{name} #${self.oper:02x}"
+				value = self.oper if type(self.oper) is int else self.oper.evaluate(labels)
+				return f"{name} #${value:02x}"
 			case Mode.IMPL:
 				return name
 			case Mode.IND:
@@ -275,15 +480,54 @@ class Instruction:
 			case _:
 				raise Exception("I dunno how to disas that")
 
+	def key(self):
+		"""A hashable key describing this instruction, such that instructions
+		that would assemble identically have equal keys. The opcode stands
+		for both the instruction and its addressing mode."""
+		return self.encoding, operand_key(self.oper)
+
+	def symbols(self):
+		"""The names of the symbols this instruction's encoding depends on"""
+		addr = getattr(self.oper, "addr", self.oper)
+		return addr.symbols() if isinstance(addr, Expression) else set()
+
+	def cycle_range(self, labels={}):
+		"""Return the (min, max) number of cycles this instruction can take,
+		or None if it isn't code"""
+		if self.mode not in self.cycles:
+			return None
+		base = self.cycles[self.mode]
+		if self.mode == Mode.REL:
+			if self.far:
+				# either the inverted branch is taken over the JMP (3-4 cycles),
+				# or it isn't, and we do the JMP (2 + 3 cycles)
+				return 3, 5
+			try:
+				next_pc = self.address + 2
+				crosses = (self.oper.get_concrete_addr(labels) ^ next_pc) & 0xff00
+				return base, base + 1 + bool(crosses)
+			except (KeyError, TypeError):
+				return base, base + 2
+		if self.page_penalty and self.mode in (Mode.ABSX, Mode.ABSY, Mode.INDY):
+			if self.mode != Mode.INDY:
+				try:
+					if self.oper.get_concrete_addr(labels) & 0xff == 0:
+						return base, base  # page-aligned, so no index can cross
+				except (KeyError, TypeError):
+					pass
+			return base, base + 1
+		return base, base
+
 	def __repr__(self):
 		return f"{self.__class__.__name__}({self.mode}, {self.oper})"
 
 
 # labels are pseudo-instructions of zero length
 class Label(Instruction):
-	length = 0
+	__slots__ = ("label",)
 
 	def __init__(self, label):
+		self.init_pseudo(0)
 		self.label = label
 
 	def assemble(self, labels):
@@ -292,64 +536,303 @@ class Label(Instruction):
 	def disas(self, labels):
 		return self.label + ":"
 
+	def key(self):
+		return "Label", self.label
+
+	def symbols(self):
+		return set()
+
 	def __repr__(self):
 		return f"Label({self.label})"
 
 
 class Org(Instruction):
-	length = 0
-
 	def __init__(self, addr):
 		assert(type(addr) is int)
-		self.address = addr
+		self.init_pseudo(0, addr)
 	
 	def assemble(self, labels):
 		return b""
 	
 	def disas(self, labels):
 		return f".org ${self.address:04x}"
+
+	def key(self):
+		return "Org", self.address
+
+	def symbols(self):
+		return set()
 	
 	def __repr__(self):
 		return f"Org({hex(self.address)})"
 
-class Dw(Instruction):
-	length = 2
+def pack_values(values, size):
+	"""Encode a sequence of ints as `size` little-endian bytes each. Raises
+	TypeError if any of them aren't ints (i.e. are symbolic)."""
+	if numpy is not None and isinstance(values, numpy.ndarray):
+		if values.dtype.kind not in "iu":
+			return pack_values(values.tolist(), size)
+		if values.size and (values.min() < 0 or values.max() >= 1 << (8 * size)):
+			raise OverflowError(f"Value out of range for {size}-byte data")
+		if size == 3:
+			return values.astype("<u4").view(numpy.uint8).reshape(-1, 4)[:, :3].tobytes()
+		return values.astype(f"<u{size}").tobytes()
+	if size == 1:
+		return bytes(values)
+	if size == 2:
+		words = array("H", values)
+		if sys.byteorder == "big":
+			words.byteswap()
+		return words.tobytes()
+	if not all(type(x) is int for x in values):
+		raise TypeError("symbolic values")
+	if numpy is not None:
+		return pack_values(numpy.array(values, dtype=numpy.int64), size)
+	return b"".join(x.to_bytes(size, "little") for x in values)
+
+
+class Data(Instruction):
+	"""Base class for data directives, holding a table of values that are each
+	encoded as `size` little-endian bytes. Values can be given individually,
+	or as a single sequence (including bytes, or a NumPy array).
+
+	Tables that are entirely literal are encoded once, up front, and `value`
+	holds the bytes. Otherwise, `value` is a tuple of ints and Expressions,
+	and only the Expressions are evaluated when it's assembled."""
+	__slots__ = ("value",)
+	size = 1
+	directive = ".db"
+
+	def __init__(self, *values):
+		if len(values) == 1 and not isinstance(values[0], (int, Expression)):
+			values = values[0]  # a whole table, rather than a single value
+		if not isinstance(values, (bytes, bytearray, list, tuple)) and \
+				not (numpy is not None and isinstance(values, numpy.ndarray)):
+			values = list(values)
+		try:
+			self.value = pack_values(values, self.size)
+		except TypeError:
+			self.value = tuple(values)
+		self.init_pseudo(len(values) * self.size)
+
+	def concrete_value(self, labels):
+		if type(self.value) is bytes:
+			return self.value
+		return pack_values([x if type(x) is int else x.evaluate(labels) for x in self.value], self.size)
 
-	def __init__(self, value):
-		self.value = Addr(value)
-	
 	def assemble(self, labels):
-		return self.value.get_concrete_addr(labels).to_bytes(2, "little")
-	
+		return self.concrete_value(labels)
+
+	def key(self):
+		if type(self.value) is bytes:
+			return type(self).__name__, self.value
+		return type(self).__name__, tuple(x.key() if isinstance(x, Expression) else x for x in self.value)
+
+	def symbols(self):
+		names = set()
+		if type(self.value) is not bytes:
+			for x in self.value:
+				if isinstance(x, Expression):
+					names |= x.symbols()
+		return names
+
+	def disas(self, labels):
+		data = self.concrete_value(labels)
+		words = (int.from_bytes(data[i:i + self.size], "little") for i in range(0, len(data), self.size))
+		return f"{self.directive} {', '.join(f'${x:0{2 * self.size}x}' for x in words)}"
+
+	def __repr__(self):
+		return f"{type(self).__name__}({self.value})"
+
+
+class Db(Data):
 	def disas(self, labels):
-		return f".dw ${self.value.get_concrete_addr(labels):04x}"
+		return f".db {repr(self.concrete_value(labels))[1:]}"
+
+
+class Dw(Data):
+	size = 2
+	directive = ".dw"
+
+
+class Dl(Data):
+	"""24-bit values, e.g. for 65816 long addresses"""
+	size = 3
+	directive = ".dl"
+
+
+# (path, offset, length) -> (file stamp, digest), for Incbin.key()
+incbin_digests = {}
+
+
+class Incbin(Instruction):
+	"""Include (part of) a binary file. Only its length is needed for layout;
+	the file is memory-mapped when first assembled, and the data is handed
+	out as a view of the mapping, so it's never copied into Python objects."""
+	__slots__ = ("path", "offset", "mapping")
+
+	def __init__(self, path, offset=0, length=None):
+		size = os.stat(path).st_size
+		if length is None:
+			length = size - offset
+		if offset < 0 or length < 0 or offset + length > size:
+			raise Exception(f"Can't include {length} bytes at offset {offset} of {path} ({size} bytes)")
+		self.init_pseudo(length)
+		self.path = path
+		self.offset = offset
+		self.mapping = None
+
+	def assemble(self, labels):
+		if not self.length:
+			return b""
+		if self.mapping is None:
+			with open(self.path, "rb") as f:
+				self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		return memoryview(self.mapping)[self.offset:self.offset + self.length]
+
+	def disas(self, labels):
+		return f'.incbin "{self.path}", {self.offset}, {self.length}'
+
+	def key(self):
+		# hash the contents, since a rewrite can keep the same size and mtime,
+		# but only again once the file has been touched (which the ctime
+		# can't help but show)
+		st = os.stat(self.path)
+		stamp = st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+		where = self.path, self.offset, self.length
+		cached = incbin_digests.get(where)
+		if cached is None or cached[0] != stamp:
+			h = hashlib.sha256()
+			if self.length:
+				with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+					with memoryview(mapping) as view:
+						h.update(view[self.offset:self.offset + self.length])
+			cached = incbin_digests[where] = stamp, h.hexdigest()
+		return ("Incbin",) + where + (cached[1],)
+
+	def symbols(self):
+		return set()
 
 	def __repr__(self):
-		return f"Dw({self.value})"
+		return f"Incbin({self.path!r}, {self.offset}, {self.length})"
 
 
-class Db(Instruction):
-	length = None
+class Align(Instruction):
+	"""Pad with `fill` bytes up to the next multiple of `n`"""
+	__slots__ = ("n", "fill")
+	padding = True
 
-	def __init__(self, value):
-		try:
-			self.length = len(value)
-			self.value = value
-		except TypeError:
-			self.length = 1
-			self.value = [value]
-	
-	def concrete_value(self, labels):
-		return bytes([Expression.cast(x).evaluate(labels) for x in self.value])
+	def __init__(self, n, fill=0):
+		self.init_pseudo(0)
+		self.n = n
+		self.fill = fill
+
+	def pad_length(self, addr, program, index):
+		return -addr % self.n
 
 	def assemble(self, labels):
-		return self.concrete_value(labels)
-	
+		return bytes([self.fill]) * self.length
+
 	def disas(self, labels):
-		return f".db {repr(self.concrete_value(labels))[1:]}"
+		return f".align {self.n}"
+
+	def key(self):
+		return "Align", self.n, self.fill
+
+	def symbols(self):
+		return set()
 
 	def __repr__(self):
-		return f"Db({self.value})"
+		return f"Align({self.n})"
+
+
+class PageGuard(Instruction):
+	"""The start or end of a block that NoPageCross() keeps within a page.
+	The start pads up to the next page if the block wouldn't fit otherwise."""
+	__slots__ = ("end", "movable", "fill")
+	padding = True
+
+	def __init__(self, end=False, movable=False, fill=0):
+		self.init_pseudo(0)
+		self.end = end
+		self.movable = movable
+		self.fill = fill
+
+	def block_end(self, addr, program, index):
+		"""Lay out the block starting at program[index] as if its contents
+		started at `addr` (padding included, since that depends on where
+		things are), returning (end address, index of its end guard)"""
+		i = index + 1
+		while i < len(program):
+			instr = program[i]
+			if type(instr) is PageGuard:
+				if instr.end:
+					return addr, i
+				addr += instr.pad_length(addr, program, i)
+				addr, i = instr.block_end(addr, program, i)
+			elif type(instr) is Org:
+				raise Exception("NoPageCross blocks can't contain an Org")
+			elif instr.padding:
+				addr += instr.pad_length(addr, program, i)
+			else:
+				addr += instr.length
+			i += 1
+		raise Exception("NoPageCross block has no end")
+
+	def pad_length(self, addr, program, index):
+		if self.end:
+			return 0
+		end, _ = self.block_end(addr, program, index)
+		if (addr & 0xff) + end - addr <= 0x100:
+			return 0
+		start = (addr + 0xff) & ~0xff
+		end, _ = self.block_end(start, program, index)
+		if end - start > 0x100:
+			raise Exception(f"NoPageCross block is {end - start} bytes, which is more than a page")
+		return start - addr
+
+	def assemble(self, labels):
+		return bytes([self.fill]) * self.length
+
+	def disas(self, labels):
+		return ".endpage" if self.end else ".nopagecross"
+
+	def key(self):
+		return "PageGuard", self.end, self.movable, self.fill
+
+	def symbols(self):
+		return set()
+
+	def __repr__(self):
+		return f"PageGuard(end={self.end})"
+
+
+def NoPageCross(*body, movable=False, fill=0):
+	"""Keep `body` within a single page, so that indexing into it (or
+	branching within it) never costs an extra cycle. With `movable`, a
+	concretise() with place=True may move the block to the end of its
+	section to avoid padding: so only use that for blocks that are never
+	fallen into, or out of, such as tables and subroutines."""
+	return [PageGuard(movable=movable, fill=fill), body, PageGuard(end=True)]
+
+
+def DbLo(*values):
+	"""A table of the low bytes of each value, as used with DbHi() for
+	split tables that can be indexed directly by X or Y"""
+	return split_table(values, 0)
+
+
+def DbHi(*values):
+	"""A table of the high bytes of each (16-bit) value"""
+	return split_table(values, 8)
+
+
+def split_table(values, shift):
+	if len(values) == 1 and not isinstance(values[0], (int, Expression)):
+		values = values[0]
+	if numpy is not None and isinstance(values, numpy.ndarray):
+		return Db((values >> shift) & 0xff)
+	return Db([(x >> shift) & 0xff for x in values])
 
 
 class ADC(Instruction):
@@ -363,6 +846,17 @@ class ADC(Instruction):
 		Mode.XIND: 0x61,
 		Mode.INDY: 0x71,
 	}
+	cycles = {
+		Mode.IMM : 2,
+		Mode.ZPG : 3,
+		Mode.ZPGX: 4,
+		Mode.ABS : 4,
+		Mode.ABSX: 4,
+		Mode.ABSY: 4,
+		Mode.XIND: 6,
+		Mode.INDY: 5,
+	}
+	page_penalty = True
 
 class AND(Instruction):
 	modes = {
@@ -375,6 +869,17 @@ class AND(Instruction):
 		Mode.XIND: 0x21,
 		Mode.INDY: 0x31,
 	}
+	cycles = {
+		Mode.IMM : 2,
+		Mode.ZPG : 3,
+		Mode.ZPGX: 4,
+		Mode.ABS : 4,
+		Mode.ABSX: 4,
+		Mode.ABSY: 4,
+		Mode.XIND: 6,
+		Mode.INDY: 5,
+	}
+	page_penalty = True
 
 class ASL(Instruction):
 	modes = {
@@ -384,77 +889,127 @@ class ASL(Instruction):
 		Mode.ABS : 0x0E,
 		Mode.ABSX: 0x1E,
 	}
+	cycles = {
+		Mode.A   : 2,
+		Mode.ZPG : 5,
+		Mode.ZPGX: 6,
+		Mode.ABS : 6,
+		Mode.ABSX: 7,
+	}
 
 class BCC(Instruction):
 	modes = {
 		Mode.REL : 0x90,
 	}
+	cycles = {
+		Mode.REL : 2,
+	}
 
 class BCS(Instruction):
 	modes = {
 		Mode.REL : 0xB0,
 	}
+	cycles = {
+		Mode.REL : 2,
+	}
 
 class BEQ(Instruction):
 	modes = {
 		Mode.REL : 0xF0,
 	}
+	cycles = {
+		Mode.REL : 2,
+	}
 
 class BIT(Instruction):
 	modes = {
 		Mode.ZPG : 0x24,
 		Mode.ABS : 0x2C,
 	}
+	cycles = {
+		Mode.ZPG : 3,
+		Mode.ABS : 4,
+	}
 
 class BMI(Instruction):
 	modes = {
 		Mode.REL : 0x30,
 	}
+	cycles = {
+		Mode.REL : 2,
+	}
 
 class BNE(Instruction):
 	modes = {
 		Mode.REL : 0xD0,
 	}
+	cycles = {
+		Mode.REL : 2,
+	}
 
 class BPL(Instruction):
 	modes = {
 		Mode.REL : 0x10,
 	}
+	cycles = {
+		Mode.REL : 2,
+	}
 
 class BRK(Instruction):
 	modes = {
 		Mode.IMPL: 0x00,
 	}
+	cycles = {
+		Mode.IMPL: 7,
+	}
 
 class BVC(Instruction):
 	modes = {
 		Mode.REL : 0x50,
 	}
+	cycles = {
+		Mode.REL : 2,
+	}
 
 class BVS(Instruction):
 	modes = {
 		Mode.REL : 0x70,
 	}
+	cycles = {
+		Mode.REL : 2,
+	}
 
 class CLC(Instruction):
 	modes = {
 		Mode.IMPL: 0x18,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
 
 class CLD(Instruction):
 	modes = {
 		Mode.IMPL: 0xD8,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
 
 class CLI(Instruction):
 	modes = {
 		Mode.IMPL: 0x58,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
 
 class CLV(Instruction):
 	modes = {
 		Mode.IMPL: 0xB8,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
 
 class CMP(Instruction):
 	modes = {
@@ -467,6 +1022,17 @@ class CMP(Instruction):
 		Mode.XIND: 0xC1,
 		Mode.INDY: 0xD1,
 	}
+	cycles = {
+		Mode.IMM : 2,
+		Mode.ZPG : 3,
+		Mode.ZPGX: 4,
+		Mode.ABS : 4,
+		Mode.ABSX: 4,
+		Mode.ABSY: 4,
+		Mode.XIND: 6,
+		Mode.INDY: 5,
+	}
+	page_penalty = True
 
 class CPX(Instruction):
 	modes = {
@@ -474,6 +1040,11 @@ class CPX(Instruction):
 		Mode.ZPG : 0xE4,
 		Mode.ABS : 0xEC,
 	}
+	cycles = {
+		Mode.IMM : 2,
+		Mode.ZPG : 3,
+		Mode.ABS : 4,
+	}
 
 class CPY(Instruction):
 	modes = {
@@ -481,6 +1052,11 @@ class CPY(Instruction):
 		Mode.ZPG : 0xC4,
 		Mode.ABS : 0xCC,
 	}
+	cycles = {
+		Mode.IMM : 2,
+		Mode.ZPG : 3,
+		Mode.ABS : 4,
+	}
 
 class DEC(Instruction):
 	modes = {
@@ -489,16 +1065,28 @@ class DEC(Instruction):
 		Mode.ABS : 0xCE,
 		Mode.ABSX: 0xDE,
 	}
+	cycles = {
+		Mode.ZPG : 5,
+		Mode.ZPGX: 6,
+		Mode.ABS : 6,
+		Mode.ABSX: 7,
+	}
 
 class DEX(Instruction):
 	modes = {
 		Mode.IMPL: 0xCA,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
 
 class DEY(Instruction):
 	modes = {
 		Mode.IMPL: 0x88,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
 
 class EOR(Instruction):
 	modes = {
@@ -511,6 +1099,17 @@ class EOR(Instruction):
 		Mode.XIND: 0x41,
 		Mode.INDY: 0x51,
 	}
+	cycles = {
+		Mode.IMM : 2,
+		Mode.ZPG : 3,
+		Mode.ZPGX: 4,
+		Mode.ABS : 4,
+		Mode.ABSX: 4,
+		Mode.ABSY: 4,
+		Mode.XIND: 6,
+		Mode.INDY: 5,
+	}
+	page_penalty = True
 
 class INC(Instruction):
 	modes = {
@@ -519,27 +1118,46 @@ class INC(Instruction):
 		Mode.ABS : 0xEE,
 		Mode.ABSX: 0xFE,
 	}
+	cycles = {
+		Mode.ZPG : 5,
+		Mode.ZPGX: 6,
+		Mode.ABS : 6,
+		Mode.ABSX: 7,
+	}
 
 class INX(Instruction):
 	modes = {
 		Mode.IMPL: 0xE8,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
 
 class INY(Instruction):
 	modes = {
 		Mode.IMPL: 0xC8,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
 
 class JMP(Instruction):
 	modes = {
 		Mode.ABS : 0x4C,
 		Mode.IND : 0x6C,
 	}
+	cycles = {
+		Mode.ABS : 3,
+		Mode.IND : 5,
+	}
 
 class JSR(Instruction):
 	modes = {
 		Mode.ABS : 0x20,
 	}
+	cycles = {
+		Mode.ABS : 6,
+	}
 
 class LDA(Instruction):
 	modes = {
@@ -552,6 +1170,17 @@ class LDA(Instruction):
 		Mode.XIND: 0xA1,
 		Mode.INDY: 0xB1,
 	}
+	cycles = {
+		Mode.IMM : 2,
+		Mode.ZPG : 3,
+		Mode.ZPGX: 4,
+		Mode.ABS : 4,
+		Mode.ABSX: 4,
+		Mode.ABSY: 4,
+		Mode.XIND: 6,
+		Mode.INDY: 5,
+	}
+	page_penalty = True
 
 class LDX(Instruction):
 	modes = {
@@ -561,6 +1190,14 @@ class LDX(Instruction):
 		Mode.ABS : 0xAE,
 		Mode.ABSY: 0xBE,
 	}
+	cycles = {
+		Mode.IMM : 2,
+		Mode.ZPG : 3,
+		Mode.ZPGY: 4,
+		Mode.ABS : 4,
+		Mode.ABSY: 4,
+	}
+	page_penalty = True
 
 class LDY(Instruction):
 	modes = {
@@ -570,6 +1207,14 @@ class LDY(Instruction):
 		Mode.ABS : 0xAC,
 		Mode.ABSX: 0xBC,
 	}
+	cycles = {
+		Mode.IMM : 2,
+		Mode.ZPG : 3,
+		Mode.ZPGX: 4,
+		Mode.ABS : 4,
+		Mode.ABSX: 4,
+	}
+	page_penalty = True
 
 class LSR(Instruction):
 	modes = {
@@ -579,11 +1224,21 @@ class LSR(Instruction):
 		Mode.ABS : 0x4E,
 		Mode.ABSX: 0x5E,
 	}
+	cycles = {
+		Mode.A   : 2,
+		Mode.ZPG : 5,
+		Mode.ZPGX: 6,
+		Mode.ABS : 6,
+		Mode.ABSX: 7,
+	}
 
 class NOP(Instruction):
 	modes = {
 		Mode.IMPL: 0xEA,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
 
 class ORA(Instruction):
 	modes = {
@@ -596,26 +1251,49 @@ class ORA(Instruction):
 		Mode.XIND: 0x01,
 		Mode.INDY: 0x11,
 	}
+	cycles = {
+		Mode.IMM : 2,
+		Mode.ZPG : 3,
+		Mode.ZPGX: 4,
+		Mode.ABS : 4,
+		Mode.ABSX: 4,
+		Mode.ABSY: 4,
+		Mode.XIND: 6,
+		Mode.INDY: 5,
+	}
+	page_penalty = True
 
 class PHA(Instruction):
 	modes = {
 		Mode.IMPL: 0x48,
 	}
+	cycles = {
+		Mode.IMPL: 3,
+	}
 
 class PHP(Instruction):
 	modes = {
 		Mode.IMPL: 0x08,
 	}
+	cycles = {
+		Mode.IMPL: 3,
+	}
 
 class PLA(Instruction):
 	modes = {
 		Mode.IMPL: 0x68,
 	}
+	cycles = {
+		Mode.IMPL: 4,
+	}
 
 class PLP(Instruction):
 	modes = {
 		Mode.IMPL: 0x28,
 	}
+	cycles = {
+		Mode.IMPL: 4,
+	}
 
 class ROL(Instruction):
 	modes = {
@@ -625,6 +1303,13 @@ class ROL(Instruction):
 		Mode.ABS : 0x2E,
 		Mode.ABSX: 0x3E,
 	}
+	cycles = {
+		Mode.A   : 2,
+		Mode.ZPG : 5,
+		Mode.ZPGX: 6,
+		Mode.ABS : 6,
+		Mode.ABSX: 7,
+	}
 
 class ROR(Instruction):
 	modes = {
@@ -634,16 +1319,29 @@ class ROR(Instruction):
 		Mode.ABS : 0x6E,
 		Mode.ABSX: 0x7E,
 	}
+	cycles = {
+		Mode.A   : 2,
+		Mode.ZPG : 5,
+		Mode.ZPGX: 6,
+		Mode.ABS : 6,
+		Mode.ABSX: 7,
+	}
 
 class RTI(Instruction):
 	modes = {
 		Mode.IMPL: 0x40,
 	}
+	cycles = {
+		Mode.IMPL: 6,
+	}
 
 class RTS(Instruction):
 	modes = {
 		Mode.IMPL: 0x60,
 	}
+	cycles = {
+		Mode.IMPL: 6,
+	}
 
 class SBC(Instruction):
 	modes = {
@@ -656,21 +1354,41 @@ class SBC(Instruction):
 		Mode.XIND: 0xE1,
 		Mode.INDY: 0xF1,
 	}
+	cycles = {
+		Mode.IMM : 2,
+		Mode.ZPG : 3,
+		Mode.ZPGX: 4,
+		Mode.ABS : 4,
+		Mode.ABSX: 4,
+		Mode.ABSY: 4,
+		Mode.XIND: 6,
+		Mode.INDY: 5,
+	}
+	page_penalty = True
 
 class SEC(Instruction):
 	modes = {
 		Mode.IMPL: 0x38,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
 
 class SED(Instruction):
 	modes = {
 		Mode.IMPL: 0xF8,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
 
 class SEI(Instruction):
 	modes = {
 		Mode.IMPL: 0x78,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
 
 class STA(Instruction):
 	modes = {
@@ -682,6 +1400,15 @@ class STA(Instruction):
 		Mode.XIND: 0x81,
 		Mode.INDY: 0x91,
 	}
+	cycles = {
+		Mode.ZPG : 3,
+		Mode.ZPGX: 4,
+		Mode.ABS : 4,
+		Mode.ABSX: 5,
+		Mode.ABSY: 5,
+		Mode.XIND: 6,
+		Mode.INDY: 6,
+	}
 
 class STX(Instruction):
 	modes = {
@@ -689,6 +1416,11 @@ class STX(Instruction):
 		Mode.ZPGY: 0x96,
 		Mode.ABS : 0x8E,
 	}
+	cycles = {
+		Mode.ZPG : 3,
+		Mode.ZPGY: 4,
+		Mode.ABS : 4,
+	}
 
 class STY(Instruction):
 	modes = {
@@ -696,39 +1428,81 @@ class STY(Instruction):
 		Mode.ZPGX: 0x94,
 		Mode.ABS : 0x8C,
 	}
+	cycles = {
+		Mode.ZPG : 3,
+		Mode.ZPGX: 4,
+		Mode.ABS : 4,
+	}
 
 class TAX(Instruction):
 	modes = {
 		Mode.IMPL: 0xAA,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
 
 class TAY(Instruction):
 	modes = {
 		Mode.IMPL: 0xA8,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
 
 class TSX(Instruction):
 	modes = {
 		Mode.IMPL: 0xBA,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
 
 class TXA(Instruction):
 	modes = {
 		Mode.IMPL: 0x8A,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
 
 class TXS(Instruction):
 	modes = {
 		Mode.IMPL: 0x9A,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
 
 class TYA(Instruction):
 	modes = {
 		Mode.IMPL: 0x98,
 	}
+	cycles = {
+		Mode.IMPL: 2,
+	}
+
+
+# every opcode byte's (Instruction subclass, Mode), or None for illegal ones
+opcodes = [None] * 0x100
+for cls in Instruction.__subclasses__():
+	for mode, opcode in cls.modes.items():
+		opcodes[opcode] = (cls, mode)
+del cls, mode, opcode
+
+opcode_of = {entry: opcode for opcode, entry in enumerate(opcodes) if entry is not None}
+
+
+inverse_branches = {
+	"BCC": "BCS", "BCS": "BCC",
+	"BEQ": "BNE", "BNE": "BEQ",
+	"BMI": "BPL", "BPL": "BMI",
+	"BVC": "BVS", "BVS": "BVC",
+}
 
 
 orig_INC = INC # TODO: don't do this, lol - I just don't want to touch autogen'd code
+orig_INC.__qualname__ = "orig_INC"  # so that pickle can still find the class
 # TODO: check the code generator into git
 
 def INC(oper=None):
@@ -739,6 +1513,7 @@ def INC(oper=None):
 	return orig_INC(oper)
 
 orig_DEC = DEC # likewise
+orig_DEC.__qualname__ = "orig_DEC"
 
 def DEC(oper=None):
 	if oper is X:
@@ -766,47 +1541,370 @@ zp = SymbolFactory(type=ZP)
 lbl = SymbolFactory(type=Addr)
 
 
+def Switch(selector, cases, default=None, table=None, name=None):
+	"""Jump to cases[value] for the (byte) value of `selector`, which may be
+	A, X, or anything LDA/LDX can load. Any other value jumps to `default`, or
+	falls through past the switch if that's None.
+
+	When the values are dense enough (or with table=True), this is a
+	bounds-checked jump table, dispatched in constant time via split lo/hi
+	tables and the RTS trick, clobbering A and X. Otherwise it's a binary
+	search of compares, clobbering A.
+
+	The switch's own labels are prefixed by `name`. By default, that's derived
+	from the selector and the cases, so that it's the same every time the
+	program is built, which means that two identical switches need to be
+	given different names."""
+	targets = {}
+	for value, target in sorted(cases.items()):
+		if type(value) is not int or not 0 <= value < 0x100:
+			raise Exception(f"Switch case {value!r} isn't a byte")
+		targets[value] = address_expr(target)
+	fallthrough = default is None
+	if not fallthrough:
+		default = address_expr(default)
+
+	if name is None:
+		key = (operand_key(selector), [(value, target.key()) for value, target in targets.items()],
+			None if fallthrough else default.key())
+		name = f"switch_{hashlib.sha256(repr(key).encode()).hexdigest()[:8]}"
+	label = lambda suffix: Symbol.make(f"{name}_{suffix}", type=Addr)
+	end = label("end")
+	if fallthrough:
+		default = end
+
+	if table is None:
+		table = len(targets) >= 4 and max(targets) - min(targets) < 3 * len(targets)
+	if table:
+		return switch_table(selector, targets, default, label), end
+	return switch_tree(selector, targets, default, fallthrough, label), end
+
+
+def address_expr(target):
+	"""An Addr-typed expression for a jump target"""
+	target = getattr(target, "addr", target)
+	return target if isinstance(target, Expression) else Literal.make(target, type=Addr)
+
+
+def switch_table(selector, targets, default, label):
+	first, last = min(targets), max(targets)
+	program = [] if selector is X else [X <= selector]
+	if first > 0:
+		program += [CPX(first), BCC(default)]
+	if last < 0xff:
+		program += [CPX(last + 1), BCS(default)]
+	# the tables are offset so that X doesn't need adjusting, and RTS jumps
+	# to the address it pops plus one, so each entry is its target minus one
+	entries = [targets.get(value, default) - 1 for value in range(first, last + 1)]
+	program += [
+		LDA(AddrIndex(label("hi") - first, X)), PHA(),
+		LDA(AddrIndex(label("lo") - first, X)), PHA(),
+		RTS(),
+		label("lo"), DbLo(entries),
+		label("hi"), DbHi(entries),
+	]
+	return program
+
+
+def switch_tree(selector, targets, default, fallthrough, label):
+	program = [] if selector is A else [A <= selector]
+	zero_flag = selector is not A  # loading it sets Z, so comparing with 0 is free
+	# each node compares with its middle value, falls through to the values
+	# above it, and branches to the values below it
+	pending = [(None, sorted(targets))]
+	while pending:
+		start, values = pending.pop()
+		if start is not None:
+			program.append(start)
+			zero_flag = False
+		if len(values) > 3:
+			i = len(values) // 2
+			below = label(f"lt{values[i]}")
+			program += [CMP(values[i]), BCC(below), BEQ(targets[values[i]])]
+			pending += [(below, values[:i]), (None, values[i + 1:])]
+			zero_flag = False
+			continue
+		for value in values:
+			if not (value == 0 and zero_flag):
+				program.append(CMP(value))
+			program.append(BEQ(targets[value]))
+		if pending or not fallthrough:
+			program.append(JMP(default))
+	return program
+
+
+# type -> whether flatten() expands items of that type, since isinstance()
+# against an ABC like Iterator is slow to do for every item
+nested_types = {list: True, tuple: True}
+
 def flatten(S):
-	if S == []:
-		return S
-	if isinstance(S[0], list):
-		return flatten(S[0]) + flatten(S[1:])
-	return S[:1] + flatten(S[1:])
+	"""Lazily yield the instructions of an arbitrarily nested program.
+
+	Lists, tuples and iterators (including generators) are expanded in order,
+	using an explicit stack rather than recursion. Anything else is yielded
+	as-is."""
+	stack = [iter(S)]
+	while stack:
+		for item in stack[-1]:
+			kind = type(item)
+			nested = nested_types.get(kind)
+			if nested is None:
+				nested = nested_types[kind] = issubclass(kind, (list, tuple, Iterator))
+			if nested:
+				stack.append(iter(item))
+				break
+			yield item
+		else:
+			stack.pop()
 
 
-def concretise(program, base=0):
-	program = flatten(program)
-	prog_out = []
-	labels = {}
+def layout(program, labels, base=0):
+	"""Assign addresses to each instruction (and label) in order"""
+	# the address after any padding never decreases as the addresses and
+	# sizes before it grow, so relax_layout() still converges
 	current_addr = base
-	for instr in program:
-		if type(instr) is Symbol:
-			labels[instr.name] = current_addr
-			instr = Label(instr.name)
-		else:
-			instr = copy(instr)
-		
-		if type(instr) == Org:
+	for index, instr in enumerate(program):
+		if type(instr) is Org:
 			current_addr = instr.address
 		else:
+			if instr.padding:
+				instr.length = instr.pad_length(current_addr, program, index)
 			instr.address = current_addr
-		
+			if type(instr) is Label:
+				labels[instr.label] = current_addr
 		current_addr += instr.length
-		prog_out.append(instr)
-	
+
+
+def split_sections(items):
+	"""Split a flat program into lists of items, starting a new one at each Org"""
+	sections = [[]]
+	for item in items:
+		if type(item) is Org and sections[-1]:
+			sections.append([])
+		sections[-1].append(item)
+	return sections
+
+
+def item_key(item):
+	"""key() for an item of a program that hasn't been concretised yet, in
+	which labels are still Symbols"""
+	if type(item) is Symbol:
+		return "Label", item.name
+	return item.key()
+
+
+def null_phase(name):
+	return nullcontext()
+
+
+def concretise(program, base=0, zeropage=True, place=False, instrument=None, labels=None):
+	"""Lay out a program, returning (concrete_prog, labels). Unless
+	`zeropage` is False, absolute operands that turn out to be in the zero
+	page get the shorter zero-page encodings. With `place`, movable
+	NoPageCross blocks are rearranged to need as little padding as possible.
+	`instrument` is an optional Instrumentation, see instrument.py.
+	`labels` can give the values of symbols defined outside the program,
+	e.g. by sections laid out earlier, which are included in the result."""
+	phase = null_phase if instrument is None else instrument.phase
+	if instrument is not None:
+		with phase("flatten"):
+			program = list(flatten(program))  # up front, so it's timed separately
+	prog_out = []
+	worklist = []
+	labels = SymbolTable(labels or ())
+	defined = set(labels)
+	with phase("copy"):
+		for instr in flatten(program):
+			if type(instr) is Symbol:
+				if instr.name in defined:
+					raise Exception(f"Label {instr.name} is defined more than once")
+				defined.add(instr.name)
+				instr = Label(instr.name)
+			else:
+				instr = copy(instr)
+				if instr.shrink(zeropage):
+					worklist.append(instr)
+			prog_out.append(instr)
+	if place:
+		with phase("place"):
+			prog_out, worklist = place_blocks(prog_out, worklist, labels, base, zeropage)
+
+	symbols = labels if instrument is None else instrument.symbols(labels)
+	evaluations = nullcontext() if instrument is None else instrument.evaluations()
+	with phase("layout"), evaluations:
+		passes = relax_layout(prog_out, worklist, symbols, base)
+	if instrument is not None and instrument.counting:
+		instrument.count("instructions", len(prog_out))
+		instrument.count("layout_passes", passes)
+		instrument.count("symbol_lookups", symbols.lookups)
+		instrument.count("evaluations", evaluations.count)
 	return prog_out, labels
 
-def assemble(program, labels):
-	memory = bytearray(0x10000)
-	for instr in program:
-		memory[instr.address:instr.address+instr.length] = instr.assemble(labels)
-	return memory
 
+def extract_blocks(section):
+	"""Split a section into its fixed items and a list of its movable
+	NoPageCross blocks (each including its guards)"""
+	fixed = []
+	blocks = []
+	depth = 0
+	for item in section:
+		if depth:
+			blocks[-1].append(item)
+			if type(item) is PageGuard:
+				depth += -1 if item.end else 1
+		elif type(item) is PageGuard and item.movable and not item.end:
+			blocks.append([item])
+			depth = 1
+		else:
+			fixed.append(item)
+	return fixed, blocks
+
+
+def place_blocks(program, worklist, labels, base=0, zeropage=True):
+	"""Move the movable NoPageCross blocks of each section of a shrink()'d
+	program to its end, in an order that packs them into the remaining space
+	of each page, best fit first, so that they need as little padding as
+	possible. Returns the new (program, worklist), ready for relax_layout()."""
+	sections = [extract_blocks(section) for section in split_sections(program)]
+	if not any(blocks for _, blocks in sections):
+		return program, worklist
+
+	# lay it out once with the blocks at the end, to find out how big
+	# everything is, and where each section's blocks start
+	trial = [instr for fixed, blocks in sections for instr in fixed + sum(blocks, [])]
+	relax_layout(trial, worklist, labels, base)
+
+	result = []
+	for fixed, blocks in sections:
+		result += fixed
+		if not blocks:
+			continue
+		addr = blocks[0][0].address
+		sizes = {id(block): block[-1].address - block[0].address - block[0].length for block in blocks}
+		remaining = sorted(blocks, key=lambda block: -sizes[id(block)])
+		while remaining:
+			space = 0x100 - (addr & 0xff)
+			block = next((b for b in remaining if sizes[id(b)] <= space), remaining[0])
+			if sizes[id(block)] > space:
+				addr += space  # nothing fits, so it'll be padded to the next page
+			addr += sizes[id(block)]
+			remaining.remove(block)
+			result += block
+
+	# everything has moved, so the relaxation has to start again
+	return result, [instr for instr in result if instr.shrink(zeropage)]
+
+
+def relax_layout(program, worklist, labels, base=0):
+	"""Lay out a program whose instructions have been shrink()'d, growing the
+	ones in `worklist` as needed. Returns the number of passes it took."""
+	# Start with every instruction at its shortest, then keep growing the ones
+	# that don't fit until nothing changes. Anything that has grown is as
+	# big as it gets, so it drops off the worklist.
+	layout(program, labels, base)
+	passes = 1
+	while worklist:
+		grown = [instr.relax(labels) for instr in worklist]
+		if not any(grown):
+			break
+		worklist = [instr for instr, g in zip(worklist, grown) if not g]
+		layout(program, labels, base)
+		passes += 1
+	check_pages(program)
+	return passes
+
+
+def check_pages(program):
+	"""Make sure that no NoPageCross block ended up crossing a page"""
+	starts = []
+	for instr in program:
+		if type(instr) is PageGuard:
+			if not instr.end:
+				starts.append(instr.address + instr.length)
+			elif instr.address > (start := starts.pop()) and (instr.address - 1) >> 8 != start >> 8:
+				raise Exception(f"NoPageCross block at ${start:04x} crosses a page")
+
+def assemble_iter(program, labels):
+	"""Lazily yield (address, bytearray) for each contiguous run of code.
+	Consecutive instructions are appended to the same run, and each Org that
+	moves the address starts a new one."""
+	segment = None
+	end = None
+	for instr in program:
+		if not instr.length:
+			continue
+		if instr.address != end:
+			if segment:
+				yield start, segment
+			start = end = instr.address
+			segment = bytearray()
+		segment += instr.encoder(instr, labels)
+		end += instr.length
+	if segment:
+		yield start, segment
+
+
+def assemble(program, labels, instrument=None):
+	if instrument is not None:
+		symbols = instrument.symbols(labels)
+		with instrument.phase("assemble"), instrument.evaluations() as evaluations:
+			image = assemble(program, symbols)
+		if instrument.counting:
+			instrument.count("symbolic_operands", sum(map(operand_count, program)))
+			instrument.count("symbol_lookups", symbols.lookups)
+			instrument.count("evaluations", evaluations.count)
+			instrument.count("bytes_emitted", sum(len(data) for _, data in image.segments))
+		return image
+
+	return Image(assemble_iter(program, labels))
+
+
+def format_cycles(lo, hi):
+	return str(lo) if lo == hi else f"{lo}-{hi}"
+
+
+def make_listing(program, labels, timing=True, instrument=None):
+	"""Produce a human-readable listing. With `timing`, each instruction is
+	annotated with its cycle count and the running total since the last
+	label, and each label block ends with a summary of its size and timing."""
+	if instrument is not None:
+		symbols = instrument.symbols(labels)
+		with instrument.phase("listing"), instrument.evaluations() as evaluations:
+			listing = make_listing(program, symbols, timing)
+		if instrument.counting:
+			instrument.count("symbol_lookups", symbols.lookups)
+			instrument.count("evaluations", evaluations.count)
+			instrument.count("listing_lines", listing.count("\n") + bool(listing))
+		return listing
 
-def make_listing(program, labels):
 	listing = []
+	block = None
+	size = lo_total = hi_total = 0
+
+	def summarise():
+		if block is not None and size:
+			summary = f"{size} byte{'' if size == 1 else 's'}"
+			if hi_total:
+				summary += f", {format_cycles(lo_total, hi_total)} cycles"
+			listing.append(f"\t\t; {block}: {summary}")
+
 	for instr in program:
-		listing.append(f"${instr.address:04x}:  {instr.assemble(labels).hex()}\t{instr.disas(labels)}")
+		line = f"${instr.address:04x}:  {instr.assemble(labels).hex()}\t{instr.disas(labels)}"
+		if timing:
+			if type(instr) in (Label, Org):
+				summarise()
+				block = instr.label if type(instr) is Label else None
+				size = lo_total = hi_total = 0
+			else:
+				size += instr.length
+				cycles = instr.cycle_range(labels)
+				if cycles is not None:
+					lo_total += cycles[0]
+					hi_total += cycles[1]
+					line += f"\t; {format_cycles(*cycles)} (total {format_cycles(lo_total, hi_total)})"
+		listing.append(line)
+	if timing:
+		summarise()
 	return "\n".join(listing)
 
 
@@ -0,0 +1,196 @@
+"""
+Bank switching support, for cartridges and boards where many banks of ROM
+share the same CPU address window.
+
+Routines are added to a Banking object by name, and pack() assigns them to
+banks, grouping routines that call each other (weighted by how often, if a
+profile is supplied) so that as few calls as possible cross between banks.
+build() then lays out each bank at the window address with its own label
+namespace, plus a fixed (always mapped) program that can see the entry point
+of every routine.
+
+JSRs to a routine in another bank are automatically redirected through a
+trampoline in the fixed area, which maps in the callee's bank with the
+user-supplied switch(n), calls it, and maps the caller's bank back in.
+Trampolines used from the fixed area, and by JMPs, don't restore anything,
+and just jump to the routine, leaving its bank mapped. So fixed code that
+calls into a bank must not itself be called from a bank, and a routine
+that JMPs into another bank must not be returned to in its own one.
+Trampolines clobber whatever switch() does.
+"""
+
+from .assembler import concretise, assemble, flatten, Addr, JMP, JSR, Mode, Org, RTS
+from .linker import Module
+from .symbolics import Symbol
+
+
+class Bank:
+	def __init__(self, number, window, size):
+		self.number = number
+		self.window = window
+		self.size = size
+		self.routines = []  # names of the routines packed into this bank
+		self.used = 0       # estimated bytes used by those routines
+		self.program = None # concretised program and labels, after build()
+		self.labels = None
+
+	@property
+	def cursor(self):
+		"""The (estimated) address at which the next routine would go"""
+		return self.window + self.used
+
+	def assemble(self):
+		"""Return the contents of the bank, as bytes"""
+		image = assemble(self.program, self.labels)
+		return bytes(image[self.window:self.window + self.size])
+
+	def __repr__(self):
+		return f"Bank({self.number}, {len(self.routines)} routines, {self.used}/{self.size} bytes)"
+
+
+class Banking:
+	def __init__(self, banks, window, size, switch):
+		"""`switch(n)` should return the instructions that map in bank n"""
+		self.banks = [Bank(n, window, size) for n in range(banks)]
+		self.switch = switch
+		self.routines = {}  # name -> program, without its entry label
+		self.pinned = {}    # name -> bank number
+		self.placement = {} # name -> Bank, after pack()
+
+	def add(self, name, program, bank=None):
+		"""Add a routine, which will be given the entry label `name`.
+		Optionally pin it to a specific bank."""
+		if name in self.routines:
+			raise Exception(f"Duplicate routine {name}")
+		self.routines[name] = list(flatten(program))
+		if bank is not None:
+			self.pinned[name] = bank
+
+	def calls(self, program):
+		"""Yield the names of the routines called (or jumped to directly) by
+		`program`"""
+		for instr in flatten(program):
+			if type(instr) in (JSR, JMP) and instr.mode == Mode.ABS:
+				target = getattr(instr.oper, "addr", None)
+				if type(target) is Symbol and target.name in self.routines:
+					yield target.name
+
+	def pack(self, weights={}):
+		"""Assign routines to banks. Each static call site counts once towards
+		the affinity between two routines, plus `weights[(caller, callee)]`
+		(e.g. call counts from Profiler.call_graph()) if given."""
+		affinity = {}
+		for name, program in self.routines.items():
+			for callee in self.calls(program):
+				if callee != name:
+					affinity[(name, callee)] = affinity.get((name, callee), 0) + 1
+		for edge, weight in weights.items():
+			if edge in affinity or all(name in self.routines for name in edge):
+				affinity[edge] = affinity.get(edge, 0) + weight
+
+		# relocatable assembly gives an upper bound on the size of each routine
+		sizes = {name: len(Module([Symbol.make(name), program])) for name, program in self.routines.items()}
+		size = self.banks[0].size
+
+		# greedily merge the clusters with the strongest affinity, as long as
+		# they'd still fit in a bank (and aren't pinned to different ones)
+		cluster = {name: [name] for name in self.routines}
+		for (caller, callee), _ in sorted(affinity.items(), key=lambda item: -item[1]):
+			a, b = cluster[caller], cluster[callee]
+			if a is b or sum(sizes[n] for n in a + b) > size:
+				continue
+			pins = {self.pinned[n] for n in a + b if n in self.pinned}
+			if len(pins) > 1:
+				continue
+			a += b
+			for name in b:
+				cluster[name] = a
+
+		# then place them, pinned ones first, then biggest first
+		clusters = list({id(c): c for c in cluster.values()}.values())
+		clusters.sort(key=lambda c: (not any(n in self.pinned for n in c), -sum(sizes[n] for n in c)))
+		for bank in self.banks:
+			bank.routines = []
+			bank.used = 0
+		self.placement = {}
+		for c in clusters:
+			total = sum(sizes[n] for n in c)
+			pins = [self.pinned[n] for n in c if n in self.pinned]
+			candidates = [self.banks[pins[0]]] if pins else self.banks
+			for bank in candidates:
+				if bank.used + total <= bank.size:
+					break
+			else:
+				raise Exception(f"Routine(s) {', '.join(c)} don't fit in any bank")
+			bank.routines += c
+			bank.used += total
+			for name in c:
+				self.placement[name] = bank
+		return self.placement
+
+	def redirect(self, program, bank, needed):
+		"""Rewrite calls to routines in other banks to go via trampolines,
+		adding the (caller bank, callee) pairs used to `needed`. The caller
+		bank is None for JMPs, which don't come back to restore it. Indirect
+		JMPs are left alone, their operand being where the target is stored."""
+		out = []
+		for instr in flatten(program):
+			if type(instr) in (JSR, JMP) and instr.mode == Mode.ABS:
+				target = getattr(instr.oper, "addr", None)
+				if type(target) is Symbol and target.name in self.placement \
+						and self.placement[target.name] is not bank:
+					pair = (bank.number if bank and type(instr) is JSR else None, target.name)
+					needed.add(pair)
+					instr = type(instr)(Addr(Symbol.make(trampoline_name(*pair), type=Addr)))
+			out.append(instr)
+		return out
+
+	def trampolines(self, needed):
+		program = []
+		for caller, callee in sorted(needed, key=lambda pair: (pair[0] is not None, pair)):
+			program.append(Symbol.make(trampoline_name(caller, callee)))
+			program.append(self.switch(self.placement[callee].number))
+			target = Addr(Symbol.make(callee, type=Addr))
+			if caller is None:
+				program.append(JMP(target))
+			else:
+				program += [JSR(target), self.switch(caller), RTS()]
+		return program
+
+	def build(self, fixed, trampoline_org):
+		"""Lay out the fixed program and every bank, returning the fixed
+		program's (concrete_prog, labels). Trampolines are placed at
+		`trampoline_org`, which should be somewhere free in the fixed area."""
+		if not self.placement:
+			self.pack()
+		needed = set()
+		fixed = self.redirect(fixed, None, needed)
+		for bank in self.banks:
+			program = [Org(bank.window)]
+			for name in bank.routines:
+				program.append(Symbol.make(name))
+				program += self.redirect(self.routines[name], bank, needed)
+			bank.program, bank.labels = concretise(program)
+			end = bank.program[-1].address + bank.program[-1].length
+			if end > bank.window + bank.size:
+				raise Exception(f"Bank {bank.number} overflows by {end - bank.window - bank.size} bytes")
+
+		fixed_prog, fixed_labels = concretise(fixed + [Org(trampoline_org)] + self.trampolines(needed))
+		for bank in self.banks:
+			for name in bank.routines:
+				if name in fixed_labels:
+					raise Exception(f"{name} is defined in both bank {bank.number} and the fixed area")
+				fixed_labels[name] = bank.labels[name]
+		for bank in self.banks:
+			for name in fixed_labels:
+				if name not in bank.labels:
+					bank.labels[name] = fixed_labels[name]
+				elif bank.labels[name] != fixed_labels[name]:
+					raise Exception(f"{name} is defined in both bank {bank.number} and the fixed area")
+		return fixed_prog, fixed_labels
+
+
+def trampoline_name(caller, callee):
+	if caller is None:
+		return f"far_{callee}"
+	return f"far_{callee}_from_{caller}"
@@ -0,0 +1,241 @@
+"""
+A content-addressed on-disk build cache.
+
+Entries are stored under `directory`, named by the SHA-256 of a stable key,
+and the least recently used ones are evicted once the cache grows past
+`max_size` bytes. Two things can be cached:
+
+- Sections: BuildCache.build() works like concretise() followed by
+  assemble(). Each Org section is looked up by a hash of its items as given,
+  before layout, and an entry holds the section's labels and bytes, along
+  with the values of the symbols from outside it that they depend on. A
+  section that hits is neither copied, laid out nor encoded: the ones that
+  missed are concretised on their own, with the labels of the others already
+  defined. If that moves anything a cached section depends on, the whole
+  program is laid out again from scratch.
+
+- Generated tables: decorate a function that returns table data with
+  @cache.table and its result will be stored, keyed on its code (and that of
+  the functions it calls) and arguments. Global state that isn't a plain
+  constant isn't part of the key, so pass a new version= when it changes.
+"""
+
+import functools
+import hashlib
+import inspect
+import json
+import marshal
+import os
+
+from .assembler import assemble_iter, concretise, flatten, item_key, split_sections, Label
+from .image import Image
+from .symbolics import Symbol
+
+# bump this whenever the encoding of anything changes, to invalidate old entries
+CACHE_VERSION = 3
+
+
+class BuildCache:
+	def __init__(self, directory=".p65a_cache", max_size=64 * 1024 * 1024):
+		self.directory = directory
+		self.max_size = max_size
+		self.size = None  # running total of the entries' sizes, once known
+		self.hits = 0
+		self.misses = 0
+
+	def path(self, digest):
+		return os.path.join(self.directory, digest[:2], digest)
+
+	def get(self, digest):
+		try:
+			with open(self.path(digest), "rb") as f:
+				data = f.read()
+		except FileNotFoundError:
+			self.misses += 1
+			return None
+		try:
+			os.utime(self.path(digest))  # mark as recently used
+		except FileNotFoundError:
+			pass  # evicted by another build since we read it
+		self.hits += 1
+		return data
+
+	def put(self, digest, data):
+		path = self.path(digest)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		tmp = f"{path}.{os.getpid()}.tmp"
+		with open(tmp, "wb") as f:
+			f.write(data)
+		os.replace(tmp, path)  # atomic, so concurrent builds never see partial entries
+		# only scan the whole directory when the running total says it's full
+		# (or at first, to find out), so that filling the cache isn't quadratic
+		if self.size is None:
+			self.evict()
+		else:
+			self.size += len(data)
+			if self.size > self.max_size:
+				self.evict()
+
+	def evict(self):
+		"""Delete the least recently used entries until we're within 3/4 of
+		max_size, so that it's a while before we need to do it again. Other
+		builds may be doing the same, so entries can vanish at any point."""
+		entries = []
+		total = 0
+		for dirpath, _, filenames in os.walk(self.directory):
+			for name in filenames:
+				path = os.path.join(dirpath, name)
+				try:
+					st = os.stat(path)
+				except FileNotFoundError:
+					continue
+				entries.append((st.st_mtime, st.st_size, path))
+				total += st.st_size
+		entries.sort()
+		if total > self.max_size:
+			for _, size, path in entries:
+				if total <= self.max_size * 3 // 4:
+					break
+				try:
+					os.remove(path)
+				except FileNotFoundError:
+					pass
+				total -= size
+		self.size = total
+
+	def section_digest(self, section, base, zeropage, place):
+		"""Hash a section of a program as given, before it's laid out"""
+		keys = [item_key(item) for item in section]
+		h = hashlib.sha256(f"section {CACHE_VERSION} {base} {zeropage} {place}".encode())
+		h.update(marshal.dumps(keys, 2))  # version 2 has no back-references, so is stable
+		return h.hexdigest()
+
+	def get_section(self, digest):
+		"""Return the (labels, deps, segments) stored for a section, or None"""
+		data = self.get(digest)
+		if data is None:
+			return None
+		size = int.from_bytes(data[:4], "little")
+		header = json.loads(data[4:4 + size])
+		segments = []
+		offset = 4 + size
+		for start, length in header["segments"]:
+			segments.append((start, bytearray(data[offset:offset + length])))
+			offset += length
+		return header["labels"], header["deps"], segments
+
+	def put_section(self, digest, labels, deps, segments):
+		header = json.dumps({
+			"labels": labels,
+			"deps": deps,
+			"segments": [[start, len(data)] for start, data in segments],
+		}).encode()
+		self.put(digest, len(header).to_bytes(4, "little") + header + b"".join(data for _, data in segments))
+
+	def build(self, program, base=0, zeropage=True, place=False):
+		"""Like concretise() followed by assemble(), but taking whatever
+		sections it can from the cache. Returns (image, labels), since the
+		sections that hit are never laid out as instructions at all."""
+		sections = split_sections(flatten(program))
+		# sections of nothing but literal data cost less to lay out and
+		# encode than to hash, so they're never cached
+		digests = [self.section_digest(section, base, zeropage, place) if worth_caching(section) else None for section in sections]
+		entries = [None if digest is None else self.get_section(digest) for digest in digests]
+
+		known = {}
+		for entry in entries:
+			if entry is not None:
+				for name, value in entry[0].items():
+					if name in known:
+						raise Exception(f"Label {name} is defined more than once")
+					known[name] = value
+		missed = [section for section, entry in zip(sections, entries) if entry is None]
+		prog, labels = concretise(missed, base, zeropage, place, labels=known)
+
+		# the cached layouts are only right if everything they refer to
+		# outside themselves ended up where it was when they were cached
+		if any(entry is not None and any(labels.get(name) != value for name, value in entry[1].items()) for entry in entries):
+			entries = [None] * len(sections)
+			prog, labels = concretise(sections, base, zeropage, place)
+
+		segments = [segment for entry in entries if entry is not None for segment in entry[2]]
+		missed_digests = [digest for digest, entry in zip(digests, entries) if entry is None]
+		for digest, section in zip(missed_digests, split_sections(prog) if missed_digests else []):
+			if digest is None:
+				segments += assemble_iter(section, labels)
+				continue
+			own = {instr.label: instr.address for instr in section if type(instr) is Label}
+			deps = set().union(*(instr.symbols() for instr in section)) - own.keys()
+			encoded = list(assemble_iter(section, labels))
+			self.put_section(digest, own, {name: labels[name] for name in sorted(deps)}, encoded)
+			segments += encoded
+		return Image(segments), labels
+
+	def table(self, fn=None, *, version=None):
+		"""Decorator caching the (bytes-like, or list of byte values) result
+		of a table generating function. The cached result is always bytes.
+
+		The key covers the function's source, and that of any functions it
+		calls by name (and so on), plus any plain constants they refer to.
+		Pass a new `version` to invalidate it for changes to anything else,
+		e.g. use as @cache.table(version=2)."""
+		if fn is None:
+			return functools.partial(self.table, version=version)
+		code = None  # hashed on the first call, once everything it calls is defined
+
+		@functools.wraps(fn)
+		def wrapper(*args, **kwargs):
+			nonlocal code
+			if code is None:
+				code = code_digest(fn)
+			key = repr((CACHE_VERSION, fn.__module__, fn.__qualname__, code, version, args, sorted(kwargs.items())))
+			digest = hashlib.sha256(f"table {key}".encode()).hexdigest()
+			data = self.get(digest)
+			if data is None:
+				data = bytes(fn(*args, **kwargs))
+				self.put(digest, data)
+			return data
+
+		return wrapper
+
+
+def worth_caching(section):
+	"""Whether a section has anything in it to lay out or evaluate"""
+	return any(type(item) is not Symbol and (item.mode is not None or item.symbols()) for item in section)
+
+
+def code_digest(fn):
+	"""Hash the source of `fn`, the functions it refers to as globals (and
+	the ones they refer to, and so on), and the plain constants they use"""
+	h = hashlib.sha256()
+	seen = set()
+	stack = [fn]
+	while stack:
+		fn = inspect.unwrap(stack.pop())
+		if fn in seen:
+			continue
+		seen.add(fn)
+		try:
+			source = inspect.getsource(fn)
+			h.update(source.encode())
+		except (OSError, TypeError):
+			source = None  # so hash the bytecode and constants instead
+
+		# names used in nested functions and comprehensions count too
+		names = set()
+		codes = [fn.__code__]
+		while codes:
+			code = codes.pop()
+			names.update(code.co_names)
+			nested = [const for const in code.co_consts if inspect.iscode(const)]
+			if source is None:
+				h.update(code.co_code)
+				h.update(repr([const for const in code.co_consts if not inspect.iscode(const)]).encode())
+			codes += nested
+		for name in sorted(names):
+			value = fn.__globals__.get(name)
+			if inspect.isfunction(value):
+				stack.append(value)
+			elif type(value) in (int, float, str, bytes, tuple, frozenset):
+				h.update(repr((name, value)).encode())
+	return h.hexdigest()
@@ -0,0 +1,290 @@
+"""
+A cycle-counting NMOS 6502 emulator, for running and timing assembled code.
+
+The opcode table is built from the `modes`, `cycles` and `page_penalty`
+attributes of each Instruction subclass. Every opcode gets its own handler
+function, generated from source templates, so executing an instruction is a
+single call through a 256-entry dispatch table.
+
+The N and Z flags are evaluated lazily: `cpu.n` holds a value whose bit 7 is
+the N flag, and `cpu.z` holds a value which is zero iff the Z flag is set.
+Use the `p` property to get or set the packed status register.
+"""
+
+from .assembler import Mode, opcodes
+
+
+OPCODES = {opcode: entry for opcode, entry in enumerate(opcodes) if entry is not None}
+
+# code that leaves the effective address in `addr` and advances the PC
+ADDRESSING = {
+	Mode.A:    "cpu.pc = pc + 1",
+	Mode.IMPL: "cpu.pc = pc + 1",
+	Mode.IMM:  "addr = pc + 1\ncpu.pc = pc + 2",
+	Mode.ZPG:  "addr = mem[pc + 1]\ncpu.pc = pc + 2",
+	Mode.ZPGX: "addr = (mem[pc + 1] + cpu.x) & 0xff\ncpu.pc = pc + 2",
+	Mode.ZPGY: "addr = (mem[pc + 1] + cpu.y) & 0xff\ncpu.pc = pc + 2",
+	Mode.ABS:  "addr = mem[pc + 1] | mem[pc + 2] << 8\ncpu.pc = pc + 3",
+	Mode.ABSX: "base = mem[pc + 1] | mem[pc + 2] << 8\naddr = (base + cpu.x) & 0xffff\ncpu.pc = pc + 3",
+	Mode.ABSY: "base = mem[pc + 1] | mem[pc + 2] << 8\naddr = (base + cpu.y) & 0xffff\ncpu.pc = pc + 3",
+	Mode.XIND: "ptr = (mem[pc + 1] + cpu.x) & 0xff\naddr = mem[ptr] | mem[(ptr + 1) & 0xff] << 8\ncpu.pc = pc + 2",
+	Mode.INDY: "ptr = mem[pc + 1]\nbase = mem[ptr] | mem[(ptr + 1) & 0xff] << 8\naddr = (base + cpu.y) & 0xffff\ncpu.pc = pc + 2",
+	# the NMOS 6502 doesn't carry into the high byte of the pointer
+	Mode.IND:  "ptr = mem[pc + 1] | mem[pc + 2] << 8\naddr = mem[ptr] | mem[(ptr & 0xff00) | ((ptr + 1) & 0xff)] << 8\ncpu.pc = pc + 3",
+	Mode.REL:  "cpu.pc = pc + 2",
+}
+
+PAGE_PENALTY = "if (base ^ addr) & 0xff00:\n\tcpu.cycles += 1"
+
+READ = "(read_hooks[addr]() if addr in read_hooks else mem[addr])"
+WRITE = "if addr in write_hooks:\n\twrite_hooks[addr]({0})\nelse:\n\tmem[addr] = {0}"
+
+BRANCH = """if {}:
+	target = (pc + 2 + ((mem[pc + 1] ^ 0x80) - 0x80)) & 0xffff
+	cpu.cycles += 1 + ((target ^ (pc + 2)) & 0xff00 != 0)
+	cpu.pc = target"""
+
+# Operation templates. `v` is the operand value (or the accumulator), and
+# STORE writes `r` back to wherever the operand came from.
+OPERATIONS = {
+	"ADC": "adc(v)",
+	"AND": "cpu.a = cpu.n = cpu.z = cpu.a & v",
+	"ASL": "cpu.c = v >> 7\nr = (v << 1) & 0xff\ncpu.n = cpu.z = r\nSTORE",
+	"BCC": BRANCH.format("not cpu.c"),
+	"BCS": BRANCH.format("cpu.c"),
+	"BEQ": BRANCH.format("not cpu.z"),
+	"BIT": "cpu.z = cpu.a & v\ncpu.n = v\ncpu.v = (v >> 6) & 1",
+	"BMI": BRANCH.format("cpu.n & 0x80"),
+	"BNE": BRANCH.format("cpu.z"),
+	"BPL": BRANCH.format("not cpu.n & 0x80"),
+	"BRK": "ret = pc + 2\npush(ret >> 8)\npush(ret & 0xff)\npush(cpu.p | 0x10)\ncpu.i = 1\ncpu.pc = mem[0xfffe] | mem[0xffff] << 8",
+	"BVC": BRANCH.format("not cpu.v"),
+	"BVS": BRANCH.format("cpu.v"),
+	"CLC": "cpu.c = 0",
+	"CLD": "cpu.d = 0",
+	"CLI": "cpu.i = 0",
+	"CLV": "cpu.v = 0",
+	"CMP": "t = cpu.a - v\ncpu.c = t >= 0\ncpu.n = cpu.z = t & 0xff",
+	"CPX": "t = cpu.x - v\ncpu.c = t >= 0\ncpu.n = cpu.z = t & 0xff",
+	"CPY": "t = cpu.y - v\ncpu.c = t >= 0\ncpu.n = cpu.z = t & 0xff",
+	"DEC": "r = (v - 1) & 0xff\ncpu.n = cpu.z = r\nSTORE",
+	"DEX": "cpu.x = cpu.n = cpu.z = (cpu.x - 1) & 0xff",
+	"DEY": "cpu.y = cpu.n = cpu.z = (cpu.y - 1) & 0xff",
+	"EOR": "cpu.a = cpu.n = cpu.z = cpu.a ^ v",
+	"INC": "r = (v + 1) & 0xff\ncpu.n = cpu.z = r\nSTORE",
+	"INX": "cpu.x = cpu.n = cpu.z = (cpu.x + 1) & 0xff",
+	"INY": "cpu.y = cpu.n = cpu.z = (cpu.y + 1) & 0xff",
+	"JMP": "cpu.pc = addr",
+	"JSR": "ret = pc + 2\npush(ret >> 8)\npush(ret & 0xff)\ncpu.pc = addr",
+	"LDA": "cpu.a = cpu.n = cpu.z = v",
+	"LDX": "cpu.x = cpu.n = cpu.z = v",
+	"LDY": "cpu.y = cpu.n = cpu.z = v",
+	"LSR": "cpu.c = v & 1\nr = v >> 1\ncpu.n = cpu.z = r\nSTORE",
+	"NOP": "pass",
+	"ORA": "cpu.a = cpu.n = cpu.z = cpu.a | v",
+	"PHA": "push(cpu.a)",
+	"PHP": "push(cpu.p | 0x10)",
+	"PLA": "cpu.a = cpu.n = cpu.z = pull()",
+	"PLP": "cpu.p = pull()",
+	"ROL": "r = ((v << 1) | cpu.c) & 0xff\ncpu.c = v >> 7\ncpu.n = cpu.z = r\nSTORE",
+	"ROR": "r = (v >> 1) | (cpu.c << 7)\ncpu.c = v & 1\ncpu.n = cpu.z = r\nSTORE",
+	"RTI": "cpu.p = pull()\nlo = pull()\ncpu.pc = pull() << 8 | lo",
+	"RTS": "lo = pull()\ncpu.pc = ((pull() << 8 | lo) + 1) & 0xffff",
+	"SBC": "sbc(v)",
+	"SEC": "cpu.c = 1",
+	"SED": "cpu.d = 1",
+	"SEI": "cpu.i = 1",
+	"STA": "r = cpu.a\nSTORE",
+	"STX": "r = cpu.x\nSTORE",
+	"STY": "r = cpu.y\nSTORE",
+	"TAX": "cpu.x = cpu.n = cpu.z = cpu.a",
+	"TAY": "cpu.y = cpu.n = cpu.z = cpu.a",
+	"TSX": "cpu.x = cpu.n = cpu.z = cpu.sp",
+	"TXA": "cpu.a = cpu.n = cpu.z = cpu.x",
+	"TXS": "cpu.sp = cpu.x",
+	"TYA": "cpu.a = cpu.n = cpu.z = cpu.y",
+}
+
+# instructions that don't need to read their operand
+NO_READ = {"STA", "STX", "STY", "JMP", "JSR"}
+
+HELPERS = """
+def push(v):
+	mem[0x100 | cpu.sp] = v
+	cpu.sp = (cpu.sp - 1) & 0xff
+
+def pull():
+	cpu.sp = (cpu.sp + 1) & 0xff
+	return mem[0x100 | cpu.sp]
+
+def adc(v):
+	a = cpu.a
+	t = a + v + cpu.c
+	if cpu.d:
+		# NMOS decimal mode: Z comes from the binary sum, N and V from the
+		# intermediate result after the low nibble is adjusted
+		lo = (a & 0x0f) + (v & 0x0f) + cpu.c
+		if lo > 9:
+			lo += 6
+		hi = (a >> 4) + (v >> 4) + (lo > 0x0f)
+		cpu.z = t & 0xff
+		cpu.n = hi << 4
+		cpu.v = ~(a ^ v) & (a ^ (hi << 4)) & 0x80 != 0
+		if hi > 9:
+			hi += 6
+		cpu.c = hi > 0x0f
+		cpu.a = ((hi << 4) | (lo & 0x0f)) & 0xff
+	else:
+		cpu.v = ~(a ^ v) & (a ^ t) & 0x80 != 0
+		cpu.c = t >> 8
+		cpu.a = cpu.n = cpu.z = t & 0xff
+
+def sbc(v):
+	if not cpu.d:
+		return adc(v ^ 0xff)
+	# NMOS decimal mode: all the flags come from the binary result
+	a = cpu.a
+	borrow = 1 - cpu.c
+	t = a - v - borrow
+	lo = (a & 0x0f) - (v & 0x0f) - borrow
+	hi = (a >> 4) - (v >> 4)
+	if lo < 0:
+		lo -= 6
+		hi -= 1
+	if hi < 0:
+		hi -= 6
+	cpu.c = t >= 0
+	cpu.v = (a ^ v) & (a ^ t) & 0x80 != 0
+	cpu.n = cpu.z = t & 0xff
+	cpu.a = ((hi << 4) | (lo & 0x0f)) & 0xff
+
+def illegal():
+	raise Exception(f"Illegal opcode ${mem[cpu.pc]:02x} at ${cpu.pc:04x}")
+"""
+
+
+def indent(code, depth=1):
+	return "\n".join("\t" * depth + line for line in code.split("\n"))
+
+
+def handler_source(opcode, cls, mode):
+	name = cls.__name__
+	lines = ["pc = cpu.pc", ADDRESSING[mode]]
+	if cls.page_penalty and mode in (Mode.ABSX, Mode.ABSY, Mode.INDY):
+		lines.append(PAGE_PENALTY)
+	if mode == Mode.A:
+		lines.append("v = cpu.a")
+		store = "cpu.a = r"
+	elif mode in (Mode.IMPL, Mode.REL):
+		store = None
+	else:
+		if name not in NO_READ:
+			lines.append(f"v = {'mem[addr]' if mode == Mode.IMM else READ}")
+		store = WRITE.format("r")
+	lines.append(OPERATIONS[name].replace("STORE", store or ""))
+	lines.append(f"cpu.cycles += {cls.cycles[mode]}")
+	return f"def op_{opcode:02x}():\n" + indent("\n".join(lines))
+
+
+def dispatch_source():
+	funcs = [handler_source(opcode, *OPCODES[opcode]) for opcode in sorted(OPCODES)]
+	table = ", ".join(f"op_{i:02x}" if i in OPCODES else "illegal" for i in range(0x100))
+	return HELPERS + "\n\n".join(funcs) + f"\n\ndispatch = [{table}]\n"
+
+
+DISPATCH_CODE = compile(dispatch_source(), "<p65a.emu dispatch>", "exec")
+
+
+class CPU:
+	"""An NMOS 6502 with a flat 64K of RAM.
+
+	`read_hooks` and `write_hooks` map addresses to callables, for emulating
+	memory-mapped I/O: read hooks take no arguments and return a byte, write
+	hooks take the byte being written."""
+
+	def __init__(self):
+		self.mem = bytearray(0x10000)
+		self.read_hooks = {}
+		self.write_hooks = {}
+		self.a = self.x = self.y = 0
+		self.sp = 0xfd
+		self.pc = 0
+		self.n = self.v = self.d = self.c = 0
+		self.i = 1
+		self.z = 1
+		self.cycles = 0
+		self.instructions = 0
+
+		# the handlers see this CPU, its memory and its hooks as globals
+		namespace = {
+			"cpu": self,
+			"mem": self.mem,
+			"read_hooks": self.read_hooks,
+			"write_hooks": self.write_hooks,
+		}
+		exec(DISPATCH_CODE, namespace)
+		self.dispatch = namespace["dispatch"]
+
+	@property
+	def p(self):
+		return (
+			(self.n & 0x80) | bool(self.v) << 6 | 0x20 | bool(self.d) << 3 |
+			bool(self.i) << 2 | (self.z == 0) << 1 | bool(self.c)
+		)
+
+	@p.setter
+	def p(self, value):
+		self.n = value & 0x80
+		self.v = value >> 6 & 1
+		self.d = value >> 3 & 1
+		self.i = value >> 2 & 1
+		self.z = 0 if value & 2 else 1
+		self.c = value & 1
+
+	def load(self, data, addr=0):
+		"""Copy an Image (or any bytes-like object, at `addr`) into memory"""
+		if hasattr(data, "views"):
+			for start, view in data.views():
+				self.mem[start:start + len(view)] = view
+		else:
+			self.mem[addr:addr + len(data)] = data
+
+	def reset(self):
+		self.sp = 0xfd
+		self.i = 1
+		self.pc = self.mem[0xfffc] | self.mem[0xfffd] << 8
+		self.cycles += 7
+
+	def step(self):
+		self.dispatch[self.mem[self.pc]]()
+		self.instructions += 1
+
+	def run(self, until=None, max_cycles=None, max_instructions=None):
+		"""Run until the PC reaches `until`, or until one of the limits is
+		hit. Returns the number of cycles executed."""
+		dispatch = self.dispatch
+		mem = self.mem
+		start = self.cycles
+		limit = float("inf") if max_cycles is None else start + max_cycles
+		remaining = -1 if max_instructions is None else max_instructions
+		count = 0
+		while self.pc != until and self.cycles < limit and count != remaining:
+			dispatch[mem[self.pc]]()
+			count += 1
+		self.instructions += count
+		return self.cycles - start
+
+	def call(self, addr, a=None, x=None, y=None, return_addr=0x0000, max_cycles=None):
+		"""Call the subroutine at `addr` as if by JSR, and run until it returns
+		to `return_addr`. Returns the number of cycles taken, excluding the
+		JSR itself but including the RTS."""
+		for reg, value in (("a", a), ("x", x), ("y", y)):
+			if value is not None:
+				setattr(self, reg, value)
+		ret = (return_addr - 1) & 0xffff
+		self.mem[0x100 | self.sp] = ret >> 8
+		self.sp = (self.sp - 1) & 0xff
+		self.mem[0x100 | self.sp] = ret & 0xff
+		self.sp = (self.sp - 1) & 0xff
+		self.pc = addr
+		return self.run(until=return_addr, max_cycles=max_cycles)
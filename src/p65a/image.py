@@ -0,0 +1,77 @@
+class Image:
+	"""A sparse memory image, made up of contiguous segments of data.
+
+	Unwritten addresses read back as `fill`. Slicing within a single segment
+	returns a zero-copy memoryview, otherwise the gaps are filled in and a
+	new bytearray is returned.
+
+	bytearray segments passed to the constructor are used as-is (and may be
+	extended in place when coalescing), rather than copied."""
+
+	def __init__(self, segments=(), size=0x10000, fill=0):
+		self.size = size
+		self.fill = fill
+		self.segments = []  # sorted, non-overlapping (start, bytearray) pairs
+
+		end = 0
+		for start, data in sorted((s, d) for s, d in segments if len(d)):
+			if start < end:
+				raise Exception(f"Overlapping writes at ${start:04x}")
+			if start + len(data) > size:
+				raise Exception(f"Segment at ${start:04x} runs past the end of memory")
+			if self.segments and start == end:
+				self.segments[-1][1].extend(data)  # coalesce adjacent segments
+			else:
+				if type(data) is not bytearray:
+					data = bytearray(data)
+				self.segments.append((start, data))
+			end = start + len(data)
+
+	def views(self):
+		"""Yield (start, memoryview) for each segment, without copying"""
+		for start, data in self.segments:
+			yield start, memoryview(data)
+
+	def find(self, addr):
+		"""Return the (start, data) segment containing addr, or None"""
+		for start, data in self.segments:
+			if start <= addr < start + len(data):
+				return start, data
+			if start > addr:
+				break
+		return None
+
+	def __len__(self):
+		return self.size
+
+	def __getitem__(self, key):
+		if isinstance(key, slice):
+			start, stop, step = key.indices(self.size)
+			if step != 1:
+				raise Exception("Image slices can't have a step")
+			stop = max(start, stop)
+			segment = self.find(start)
+			if segment is not None and stop <= segment[0] + len(segment[1]):
+				return memoryview(segment[1])[start - segment[0]:stop - segment[0]]
+			out = bytearray([self.fill]) * (stop - start)
+			for seg_start, data in self.segments:
+				lo = max(start, seg_start)
+				hi = min(stop, seg_start + len(data))
+				if lo < hi:
+					out[lo - start:hi - start] = memoryview(data)[lo - seg_start:hi - seg_start]
+			return out
+		if key < 0:
+			key += self.size
+		if not 0 <= key < self.size:
+			raise IndexError("Image index out of range")
+		segment = self.find(key)
+		if segment is None:
+			return self.fill
+		return segment[1][key - segment[0]]
+
+	def __bytes__(self):
+		return bytes(self[:])
+
+	def __repr__(self):
+		ranges = ", ".join(f"${s:04x}-${s + len(d) - 1:04x}" for s, d in self.segments)
+		return f"Image({ranges})"
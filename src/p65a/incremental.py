@@ -0,0 +1,225 @@
+"""
+Incremental re-assembly, for edit-assemble-test loops on large programs.
+
+A Session remembers the previous build, section by section (splitting the
+program at each Org). When a program is assembled again, each section is
+matched against the last build's: first by the identity of its items, which
+costs next to nothing for a caller that holds on to the sections it hasn't
+changed, then by a key. That's whatever the caller passed for the section in
+`keys` (e.g. the name and mtime of the file it came from), or else its
+structure (item_key() of each item), which is only worked out for sections
+that didn't match by identity.
+
+A matched section keeps its layout, and only the sections that changed are
+laid out again, with the labels of the others already defined. If that
+changes whether any branch or zero-page operand in a kept section can reach
+its target, everything is laid out again from scratch. A kept section reuses
+its bytes, with just the instructions that refer to symbols whose values
+have changed re-encoded in place.
+
+The result is always the same as a from-scratch concretise() + assemble().
+Items are assumed not to be modified in place between builds.
+"""
+
+from copy import copy
+
+from .assembler import abs_modes, assemble_iter, flatten, item_key, relax_layout, split_sections, Label, Mode
+from .image import Image
+from .symbolics import Symbol, SymbolTable
+
+
+class SectionState:
+	"""What a Session remembers about one section of the last build"""
+
+	def __init__(self, items, instrs, worklist, key=None):
+		self.items = items        # as given, kept alive so that their ids stay unique
+		self.instrs = instrs      # concretised
+		self.worklist = worklist  # instructions whose size depends on the layout
+		self.labels = {}          # label -> address
+		self.symbolic = None      # (instr, names) for each that refers to symbols, once needed
+		self.watched = None       # the same for `worklist`
+		self.start = None         # its bytes, from the last build
+		self.data = b""
+		self.count = 0            # instructions those bytes were encoded from
+		self._key = key
+
+	def key(self):
+		"""The caller's key for this section, or else its structural key"""
+		if self._key is None:
+			self._key = tuple(item_key(item) for item in self.items)
+		return self._key
+
+	def update_labels(self):
+		self.labels = {instr.label: instr.address for instr in self.instrs if type(instr) is Label}
+
+	def layout_holds(self, labels, changed):
+		"""Whether every size choice made in laying out this section is still
+		the one a fresh layout would make, now that the `changed` symbols have
+		the values in `labels`"""
+		if self.watched is None:
+			self.watched = [(instr, instr.symbols()) for instr in self.worklist]
+		for instr, names in self.watched:
+			if names.isdisjoint(changed):
+				continue  # neither it nor its target has moved
+			short = not instr.far if instr.mode == Mode.REL else instr.mode in abs_modes
+			if instr.fits(labels) != short:
+				return False
+		return True
+
+	def encode(self, labels):
+		runs = list(assemble_iter(self.instrs, labels))
+		# there are no Orgs after the first, so there's one run at most
+		self.start, self.data = (runs[0][0], bytes(runs[0][1])) if runs else (None, b"")
+		self.count = sum(1 for instr in self.instrs if instr.length)
+
+	def reencode(self, labels, changed):
+		"""Re-encode, in place, the instructions that refer to any of the
+		`changed` symbols. Returns how many there were."""
+		if self.symbolic is None:
+			self.symbolic = [(instr, instr.symbols()) for instr in self.instrs if instr.length]
+			self.symbolic = [(instr, names) for instr, names in self.symbolic if names]
+		affected = [instr for instr, names in self.symbolic if not names.isdisjoint(changed)]
+		if affected:
+			data = bytearray(self.data)
+			for instr in affected:
+				offset = instr.address - self.start
+				data[offset:offset + instr.length] = instr.encoder(instr, labels)
+			# as bytes, so that Image never extends them in place
+			self.data = bytes(data)
+		return len(affected)
+
+
+class Session:
+	def __init__(self, base=0):
+		self.base = base
+		self.states = []    # in program order, for the last build
+		self.by_id = {}     # tuple of item ids -> SectionState, for the last build
+		self.kept = set()   # ids of the states whose layout was kept
+		self.values = {}    # label -> address, for the last build
+		self.moved = set()  # labels whose values that build changed
+		self.relaid = False  # whether the kept sections had to be laid out again
+		self.reused = 0     # stats for the last build
+		self.reencoded = 0
+		self.laid_out = 0   # sections laid out
+
+	def changed(self, labels):
+		"""The names of the labels that have been defined, undefined or moved
+		since the last build"""
+		old = self.values
+		changed = {name for name in labels if old.get(name) != labels[name]}
+		return changed.union(name for name in old if name not in labels)
+
+	def match(self, sections, keys):
+		"""Find (and claim) the state from the last build of each section, or
+		None for the new ones. Returns (states, the new ones' keys)."""
+		states = [self.by_id.pop(tuple(map(id, section)), None) for section in sections]
+		new_keys = {}
+		if None in states and self.by_id:
+			# only sections with the same number of items can have the same key
+			lengths = {len(state.items) for state in self.by_id.values()}
+			new_lengths = {len(section) for section, state in zip(sections, states) if state is None}
+			spare = {}
+			for state in self.by_id.values():
+				if state._key is not None or len(state.items) in new_lengths:
+					spare.setdefault(state.key(), state)
+			for index, section in enumerate(sections):
+				if states[index] is None and (keys[index] or len(section) in lengths):
+					key = keys[index] or tuple(item_key(item) for item in section)
+					states[index] = spare.pop(key, None)
+					if states[index] is None:
+						new_keys[index] = key
+					else:
+						states[index].items = section  # the new objects are the ones to look for next time
+		for state, key in zip(states, keys):
+			if state is not None and key is not None:
+				state._key = key
+		return states, new_keys
+
+	def concretise(self, program, keys=None):
+		sections = split_sections(flatten(program))
+		if keys is None:
+			keys = [None] * len(sections)
+		elif len(keys) != len(sections):
+			raise Exception(f"Got {len(keys)} keys for {len(sections)} sections")
+		else:
+			keys = [None if key is None else ("key", key) for key in keys]
+		states, new_keys = self.match(sections, keys)
+		kept = [state for state in states if state is not None]
+
+		labels = SymbolTable()
+		for state in kept:
+			for name, addr in state.labels.items():
+				if name in labels:
+					raise Exception(f"Label {name} is defined more than once")
+				labels[name] = addr
+
+		# copy and lay out just the new sections, around the kept ones
+		defined = set(labels)
+		prog_out = []
+		worklist = []
+		for index, section in enumerate(sections):
+			if states[index] is not None:
+				continue
+			instrs = []
+			shrunk = []
+			for item in section:
+				if type(item) is Symbol:
+					if item.name in defined:
+						raise Exception(f"Label {item.name} is defined more than once")
+					defined.add(item.name)
+					instr = Label(item.name)
+				else:
+					instr = copy(item)
+					if instr.shrink():
+						shrunk.append(instr)
+				instrs.append(instr)
+			states[index] = SectionState(section, instrs, shrunk, keys[index] or new_keys.get(index))
+			prog_out += instrs
+			worklist += shrunk
+		if prog_out:
+			relax_layout(prog_out, worklist, labels, self.base)
+
+		prog_out = [instr for state in states for instr in state.instrs]
+		changed = self.changed(labels)
+		self.relaid = not all(state.layout_holds(labels, changed) for state in kept)
+		if self.relaid:
+			# something a kept section's layout hinged on has changed, so lay
+			# out everything again, as concretise() would
+			worklist = []
+			for state in states:
+				state.worklist = [instr for instr in state.instrs if instr.shrink()]
+				worklist += state.worklist
+			relax_layout(prog_out, worklist, labels, self.base)
+			kept = []
+		self.kept = set(map(id, kept))
+		for state in states:
+			if id(state) not in self.kept:
+				state.update_labels()
+		self.laid_out = len(states) - len(kept)
+		self.moved = changed if not self.relaid else self.changed(labels)
+		self.values = {name: labels[name] for name in labels}
+
+		self.states = states
+		self.by_id = {tuple(map(id, state.items)): state for state in states}
+		return prog_out, labels
+
+	def assemble(self, program, keys=None):
+		"""Returns (concrete_prog, labels, image), as concretise() and
+		assemble() would. `keys`, if given, has a key (or None) for each Org
+		section of the program, which must change whenever the section does."""
+		prog_out, labels = self.concretise(program, keys)
+
+		segments = []
+		self.reused = self.reencoded = 0
+		for state in self.states:
+			if id(state) in self.kept:
+				reencoded = state.reencode(labels, self.moved) if self.moved else 0
+				self.reused += state.count - reencoded
+				self.reencoded += reencoded
+			else:
+				state.encode(labels)
+				self.reencoded += state.count
+			if state.data:
+				segments.append((state.start, state.data))
+
+		return prog_out, labels, Image(segments)
@@ -0,0 +1,164 @@
+"""
+Timing and counters for the assembly pipeline.
+
+Pass an Instrumentation object as `instrument=` to concretise(), assemble()
+and make_listing(), and it records how long each phase took, along with:
+
+- instructions: items laid out by concretise()
+- layout_passes: passes of layout() needed to relax branches and operands
+- symbol_lookups: symbol table lookups, in all of the above
+- evaluations: expressions evaluated, in all of the above, however many
+  nodes each has
+- symbolic_operands: operands (or data elements) given as expressions rather
+  than numbers, in the instructions assemble() encoded. This is a count of
+  the program, not of evaluations.
+- bytes_emitted: by assemble()
+- listing_lines: by make_listing()
+
+Phases are "flatten", "place" (only with place=True), "copy" and "layout" for
+concretise(), then "assemble" and "listing". Times and counts accumulate over
+repeated calls. Hooks are called as hook(event, name, value) for each
+"start" and "end" of a phase (the value being its duration, at the end) and
+for each "count" added, so they can be forwarded to a metrics system as
+they happen.
+
+Without an Instrumentation object, none of this costs anything beyond a
+check per call. With one, symbol lookups and Expression.evaluate() go
+through counting wrappers, installed only for the duration of each
+instrumented phase, and the counters take an extra pass over the program,
+so expect the
+instrumented phases to run a little slower. Instrumentation(counting=False)
+records only the timings, skipping both.
+"""
+
+import time
+from collections.abc import MutableMapping
+from contextlib import contextmanager, nullcontext
+
+from .symbolics import Expression
+
+
+class Instrumentation:
+	def __init__(self, *hooks, counting=True):
+		self.timings = {}   # phase -> total seconds
+		self.counters = {}  # name -> total count
+		self.hooks = list(hooks)
+		self.counting = counting
+
+	def add_hook(self, hook):
+		"""Register hook(event, name, value). Returns it, so it can be used
+		as a decorator."""
+		self.hooks.append(hook)
+		return hook
+
+	def notify(self, event, name, value):
+		for hook in self.hooks:
+			hook(event, name, value)
+
+	@contextmanager
+	def phase(self, name):
+		self.notify("start", name, None)
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			elapsed = time.perf_counter() - start
+			self.timings[name] = self.timings.get(name, 0.0) + elapsed
+			self.notify("end", name, elapsed)
+
+	def count(self, name, n=1):
+		self.counters[name] = self.counters.get(name, 0) + n
+		self.notify("count", name, n)
+
+	def symbols(self, labels):
+		"""Wrap a symbol table, to count lookups into it"""
+		return CountingSymbols(labels) if self.counting else labels
+
+	def evaluations(self):
+		"""A context manager that counts expression evaluations while in effect"""
+		return CountingEvaluations() if self.counting else nullcontext()
+
+	def as_dict(self):
+		"""The results, in a form that can be serialised as JSON"""
+		return {"timings": dict(self.timings), "counters": dict(self.counters)}
+
+	def report(self):
+		"""The results, as human-readable text"""
+		lines = [f"{name:>21}: {seconds * 1000:10.2f} ms" for name, seconds in self.timings.items()]
+		lines += [f"{name:>21}: {count:10}" for name, count in self.counters.items()]
+		return "\n".join(lines)
+
+	def __repr__(self):
+		return f"Instrumentation({self.as_dict()!r})"
+
+
+class CountingSymbols(MutableMapping):
+	"""Passes everything through to a symbol table, counting lookups"""
+
+	def __init__(self, labels):
+		self.labels = labels
+		self.lookups = 0
+
+	def __getitem__(self, name):
+		self.lookups += 1
+		return self.labels[name]
+
+	def __setitem__(self, name, value):
+		self.labels[name] = value
+
+	def __delitem__(self, name):
+		del self.labels[name]
+
+	def __iter__(self):
+		return iter(self.labels)
+
+	def __len__(self):
+		return len(self.labels)
+
+	def __contains__(self, name):
+		return name in self.labels
+
+
+class CountingEvaluations:
+	"""While in effect, wraps evaluate() in Expression and each subclass that
+	overrides it, to count evaluations of whole expressions (and not of the
+	subexpressions they evaluate along the way)"""
+
+	def __init__(self):
+		self.count = 0
+		self.depth = 0
+		self.originals = {}  # class -> its own evaluate()
+
+	def wrap(self, evaluate):
+		def counting(expr, symbols):
+			if not self.depth:
+				self.count += 1
+			self.depth += 1
+			try:
+				return evaluate(expr, symbols)
+			finally:
+				self.depth -= 1
+		return counting
+
+	def __enter__(self):
+		classes = [Expression]
+		while classes:
+			cls = classes.pop()
+			if "evaluate" in cls.__dict__:
+				self.originals[cls] = cls.__dict__["evaluate"]
+				cls.evaluate = self.wrap(self.originals[cls])
+			classes += cls.__subclasses__()
+		return self
+
+	def __exit__(self, *exc):
+		for cls, evaluate in self.originals.items():
+			cls.evaluate = evaluate
+		self.originals = {}
+
+
+def operand_count(instr):
+	"""The number of operands of `instr` that are expressions"""
+	value = getattr(instr, "value", None)
+	if type(value) is tuple:
+		return sum(isinstance(x, Expression) for x in value)
+	return int(isinstance(getattr(instr.oper, "addr", instr.oper), Expression))
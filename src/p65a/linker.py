@@ -0,0 +1,186 @@
+"""
+Relocatable modules, and a linker to place them.
+
+A Module is a program that has been assembled once, at offset 0, into raw
+bytes plus a table of relocations: (offset, kind, expression) for each field
+whose value depends on a symbol. link() places any number of modules and
+patches their relocations, without laying anything out again, so a library
+can be assembled once and then cheaply linked into many different ROMs.
+
+Since a module doesn't know where it'll end up, symbolic absolute operands
+are never shrunk to zero-page encodings (explicitly ZP-typed ones still
+are zero-page, and get one-byte relocations). Branches to labels within the
+same module are position-independent and need no relocation. Branches to
+anything else can't be assumed to be in range, so they are always expanded
+to an inverted branch over a JMP.
+
+By default every label in a module is exported, i.e. global. Given a list of
+`exports`, only those are, and the rest are local to the module, so that two
+modules can each have their own `loop`. References are always resolved
+against the module's own labels first.
+
+A module that starts with an Org is instead assembled in place, at that
+address, and only needs relocations for references to other modules. This is
+what assemble_parallel() uses to assemble each Org section of a program in a
+separate process.
+"""
+
+import os
+from collections import ChainMap
+from concurrent.futures import ProcessPoolExecutor
+
+from .assembler import concretise, flatten, pack_values, split_sections, Align, Data, JMP, Label, Mode, Org, PageGuard
+from .image import Image
+from .symbolics import Expression, SymbolTable
+
+BYTE = "byte"
+WORD = "word"
+LONG = "long"
+
+kind_sizes = {BYTE: 1, WORD: 2, LONG: 3}
+size_kinds = {size: kind for kind, size in kind_sizes.items()}
+
+
+def placeholder(instr):
+	"""The encoding of `instr` with every relocated field zeroed"""
+	if isinstance(instr, Data):
+		return pack_values([x if type(x) is int else 0 for x in instr.value], instr.size)
+	if instr.far:
+		return bytes([instr.encoding[0] ^ 0x20, 3, JMP.modes[Mode.ABS], 0, 0])
+	return instr.encoding + bytes(instr.length - 1)
+
+
+class Module:
+	def __init__(self, program, name=None, exports=None):
+		self.name = name
+		program = list(flatten(program))
+		self.base = program[0].address if program and type(program[0]) is Org else None
+		if any(type(instr) is Org for instr in program[1:]):
+			raise Exception("Modules can only have an Org at the start")
+		prog, labels = concretise(program, zeropage=self.base is not None)
+		origin = self.base or 0
+		# padding was worked out relative to the origin, so it's only right
+		# if the module is placed at a multiple of the largest alignment
+		self.align = max([instr.n for instr in prog if type(instr) is Align] +
+			[0x100 for instr in prog if type(instr) is PageGuard] + [1])
+		self.locals = {instr.label: instr.address - origin for instr in prog if type(instr) is Label}
+		if exports is None:
+			exports = self.locals
+		undefined = set(exports) - self.locals.keys()
+		if undefined:
+			raise Exception(f"{name or 'Module'} exports undefined symbol(s) {', '.join(sorted(undefined))}")
+		self.exports = {label: self.locals[label] for label in exports}
+		self.imports = set()
+		self.relocations = []
+
+		data = bytearray()
+		for instr in prog:
+			if not instr.length:
+				continue
+			names = instr.symbols()
+			if not names:
+				data += instr.assemble(labels)
+				continue
+			external = names - self.locals.keys()
+			self.imports |= external
+			if self.base is not None and not external:
+				data += instr.assemble(labels)  # we already know where everything is
+				continue
+			relocs = self.relocate(instr, origin)
+			if relocs:
+				self.relocations += relocs
+				data += placeholder(instr)
+			else:
+				data += instr.assemble(labels)
+		self.data = bytes(data)
+
+	def relocate(self, instr, origin):
+		"""Return the relocations needed by an instruction that refers to symbols"""
+		addr = instr.address - origin
+		if isinstance(instr, Data):
+			kind = size_kinds[instr.size]
+			return [(addr + i * instr.size, kind, x) for i, x in enumerate(instr.value) if isinstance(x, Expression)]
+		if instr.mode == Mode.IMM:
+			return [(addr + 1, BYTE, instr.oper)]
+		target = instr.oper.addr
+		if instr.mode == Mode.REL:
+			# external targets are never assumed to be in range, so near
+			# branches are always internal, and the same wherever we end up
+			return [(addr + 3, WORD, target)] if instr.far else []
+		return [(addr + 1, WORD if instr.length == 3 else BYTE, target)]
+
+	def __len__(self):
+		return len(self.data)
+
+	def __repr__(self):
+		return f"Module({self.name!r}, {len(self.data)} bytes, {len(self.relocations)} relocations)"
+
+
+def link(modules, base=0, symbols={}):
+	"""Place and link modules, returning (image, labels).
+
+	Each entry of `modules` is either a Module, which is placed at its own
+	Org if it has one, else right after the previous one (or at `base`),
+	rounded up to its alignment, or an (address, Module) tuple. Exported
+	labels are global, and `symbols` may define any extra ones the modules
+	refer to, such as hardware registers. The returned labels are only the
+	global ones."""
+	labels = SymbolTable(symbols)
+	placed = []
+	addr = base
+	for entry in modules:
+		if type(entry) is tuple:
+			addr, module = entry
+			if module.base is not None and module.base != addr:
+				raise Exception(f"{module.name or 'Module'} was assembled for ${module.base:04x}, not ${addr:04x}")
+		else:
+			module = entry
+			if module.base is not None:
+				addr = module.base
+			else:
+				addr += -addr % module.align
+		if module.base is None and addr % module.align:
+			raise Exception(f"{module.name or 'Module'} must be placed at a multiple of ${module.align:x}")
+		for name, offset in module.exports.items():
+			if name in labels:
+				raise Exception(f"Duplicate definition of symbol {name} in {module.name or 'module'}")
+			labels[name] = addr + offset
+		placed.append((addr, module))
+		addr += len(module)
+
+	segments = []
+	for addr, module in placed:
+		data = bytearray(module.data)
+		symbols = ChainMap({name: addr + offset for name, offset in module.locals.items()}, labels)
+		for offset, kind, expr in module.relocations:
+			try:
+				value = expr.evaluate(symbols)
+			except KeyError as e:
+				raise Exception(f"Undefined symbol {e.args[0]} in {module.name or 'module'}") from None
+			size = kind_sizes[kind]
+			if not 0 <= value < 1 << 8 * size:
+				raise Exception(f"{kind.capitalize()} value {value} is out of range in {module.name or 'module'}")
+			data[offset:offset + size] = value.to_bytes(size, "little")
+		segments.append((addr, data))
+	return Image(segments), labels
+
+
+def assemble_parallel(program, base=0, max_workers=None):
+	"""Assemble each Org section of a program in a separate process, then
+	link them, returning (image, labels).
+
+	The output is the same as concretise() + assemble() would give, except
+	that references between sections are never shrunk to zero-page encodings,
+	and branches between sections are always expanded, because neither is
+	known to be in range until everything has been laid out."""
+	sections = [s for s in split_sections(flatten(program)) if s]
+	if sections and type(sections[0][0]) is not Org:
+		sections[0].insert(0, Org(base))
+	if max_workers is None:
+		max_workers = min(len(sections), os.cpu_count() or 1)
+	if max_workers <= 1:
+		modules = list(map(Module, sections))
+	else:
+		with ProcessPoolExecutor(max_workers) as pool:
+			modules = list(pool.map(Module, sections))
+	return link(modules)
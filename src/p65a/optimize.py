@@ -0,0 +1,175 @@
+"""
+A peephole optimizer, which runs over a flattened program before layout:
+
+	concrete_prog, labels = concretise(optimize(program))
+
+Rules are indexed by the class of the instruction they start matching at, so
+each instruction is only offered to the rules that could apply to it, and
+the pass stays linear. A rule is called as rule(ctx, i), where ctx.program
+is the flattened program and i is the index of the current instruction. It
+returns None if it doesn't match, or a (replacement, consumed) tuple, which
+replaces program[i:i+consumed] with the list `replacement`.
+
+Use rule() to register extra rules, or pass your own table to optimize().
+
+Note that lda_after_sta assumes ordinary RAM: don't use it on programs that
+store to and then read back from memory-mapped I/O registers.
+"""
+
+from .assembler import (
+	flatten, operand_key, Mode, Addr, A,
+	AND, ASL, BCC, BCS, BEQ, BIT, BMI, BNE, BPL, BVC, BVS, CMP, CPX, CPY,
+	DEX, DEY, EOR, INX, INY, JMP, JSR, LDA, LDX, LDY, LSR, ORA, PLA, PLP,
+	ROL, ROR, RTS, STA, STX, STY, TAX, TAY, TSX, TXA, TYA, ADC, SBC,
+	orig_INC, orig_DEC,
+)
+from .symbolics import Symbol
+
+RULES = {}  # instruction class -> list of rules
+
+BRANCHES = (BCC, BCS, BEQ, BMI, BNE, BPL, BVC, BVS)
+
+# instructions that overwrite N and Z without looking at them first
+NZ_CLOBBERS = (
+	LDA, LDX, LDY, TAX, TAY, TXA, TYA, TSX, INX, INY, DEX, DEY, orig_INC,
+	orig_DEC, AND, ORA, EOR, ADC, SBC, ASL, LSR, ROL, ROR, CMP, CPX, CPY,
+	BIT, PLA, PLP,
+)
+
+
+def rule(*classes, table=RULES):
+	"""Decorator registering a rule to be tried at instructions of the given classes"""
+	def register(fn):
+		for cls in classes:
+			table.setdefault(cls, []).append(fn)
+		return fn
+	return register
+
+
+def jump_target(oper):
+	"""The label name an Addr operand refers to, if it's a plain label"""
+	if type(oper) is Addr and type(oper.addr) is Symbol:
+		return oper.addr.name
+	return None
+
+
+class Context:
+	def __init__(self, program):
+		self.program = program
+
+		# labels that point directly at a JMP to another label
+		jumps = {}
+		pending = []
+		for instr in program:
+			if type(instr) is Symbol:
+				pending.append(instr.name)
+				continue
+			if type(instr) is JMP and instr.mode == Mode.ABS and jump_target(instr.oper):
+				for name in pending:
+					jumps[name] = jump_target(instr.oper)
+			pending.clear()
+
+		# follow chains of jumps through to their final destination
+		self.jump_targets = {}
+		for name in jumps:
+			seen = {name}
+			target = jumps[name]
+			while target in jumps and target not in seen:
+				seen.add(target)
+				target = jumps[target]
+			if target not in seen:
+				self.jump_targets[name] = target
+
+	def peek(self, i):
+		return self.program[i] if i < len(self.program) else None
+
+
+@rule(TAX, TAY, TXA, TYA)
+def redundant_transfer(ctx, i):
+	"""TAX; TXA => TAX (and likewise for Y). The second transfer doesn't
+	change any registers, and sets N and Z from the same value."""
+	inverse = {TAX: TXA, TXA: TAX, TAY: TYA, TYA: TAY}
+	if type(ctx.peek(i + 1)) is inverse[type(ctx.program[i])]:
+		return [ctx.program[i]], 2
+	return None
+
+
+@rule(STA, STX, STY)
+def lda_after_sta(ctx, i):
+	"""STA x; LDA x => STA x (and likewise for X and Y), as long as the flags
+	the load would have set get overwritten straight afterwards"""
+	store = ctx.program[i]
+	load = ctx.peek(i + 1)
+	loads = {STA: LDA, STX: LDX, STY: LDY}
+	if type(load) is not loads[type(store)] or load.mode != store.mode:
+		return None
+	if operand_key(load.oper) != operand_key(store.oper):
+		return None
+	if not isinstance(ctx.peek(i + 2), NZ_CLOBBERS):
+		return None
+	return [store], 2
+
+
+@rule(JSR)
+def tail_call(ctx, i):
+	"""JSR x; RTS => JMP x"""
+	if type(ctx.peek(i + 1)) is RTS:
+		return [JMP(ctx.program[i].oper)], 2
+	return None
+
+
+@rule(JMP, *BRANCHES)
+def jump_to_jump(ctx, i):
+	"""Branches and jumps to a label that immediately JMPs elsewhere go
+	straight to the final destination"""
+	instr = ctx.program[i]
+	if instr.mode not in (Mode.ABS, Mode.REL):
+		return None
+	target = ctx.jump_targets.get(jump_target(instr.oper))
+	if target is None:
+		return None
+	return [type(instr)(Addr(Symbol.make(target, type=Addr)))], 1
+
+
+@rule(LSR, ASL)
+def long_shift(ctx, i):
+	"""Runs of 6 or more shifts of A are replaced with cheaper sequences that
+	give the same result and flags, e.g. LSR A x7 => ROL A; ROL A; AND #$01"""
+	cls = type(ctx.program[i])
+	if ctx.program[i].mode != Mode.A:
+		return None
+	n = 1
+	while type(ctx.peek(i + n)) is cls and ctx.peek(i + n).mode == Mode.A:
+		n += 1
+	if n < 6:
+		return None
+	rotate, opposite = (ROL, ASL) if cls is LSR else (ROR, LSR)
+	if n < 8:
+		# rotating the other way through carry, then masking
+		mask = 0xff >> n if cls is LSR else (0xff << n) & 0xff
+		return [rotate(A) for _ in range(9 - n)] + [AND(mask)], n
+	if n == 8:
+		# the last bit shifted out ends up in carry, and A is zero
+		return [opposite(A), LDA(0)], n
+	return [LDA(0), cls(A)], n
+
+
+def optimize(program, rules=RULES):
+	"""Return a flat, optimized copy of the program"""
+	program = list(flatten(program))
+	ctx = Context(program)
+	out = []
+	i = 0
+	while i < len(program):
+		instr = program[i]
+		for fn in rules.get(type(instr), ()):
+			result = fn(ctx, i)
+			if result is not None:
+				replacement, consumed = result
+				out.extend(replacement)
+				i += consumed
+				break
+		else:
+			out.append(instr)
+			i += 1
+	return out
@@ -0,0 +1,205 @@
+"""
+Writers that stream assembled code out to a file (or anything else with a
+`write` method that accepts bytes, e.g. `socket.makefile("wb")`).
+
+Data can be fed in piece by piece with write(), straight from a concretised
+program with write_program(), or from an Image with write_image(). Call
+close() (or use the writer as a context manager) to finish the output off.
+"""
+
+from abc import ABC, abstractmethod
+
+from .assembler import assemble_iter
+
+
+class Writer(ABC):
+	def __init__(self, sink):
+		self.sink = sink
+
+	@abstractmethod
+	def write(self, addr, data):
+		pass
+
+	def close(self):
+		pass
+
+	def write_program(self, program, labels):
+		# one write per contiguous run of code, rather than per instruction
+		for addr, data in assemble_iter(program, labels):
+			self.write(addr, data)
+
+	def write_image(self, image):
+		for addr, data in image.views():
+			self.write(addr, data)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+
+
+class BinWriter(Writer):
+	"""Raw binary covering addresses `start` up to `end`, with any gaps
+	filled in. Since the output is written sequentially, data must arrive in
+	ascending address order. Anything outside the range is dropped."""
+
+	def __init__(self, sink, start=0, end=None, fill=0):
+		super().__init__(sink)
+		self.start = start
+		self.end = end
+		self.fill = fill
+		self.offset = start  # the next address to be written to the sink
+
+	def pad_to(self, addr):
+		block = bytes([self.fill]) * min(addr - self.offset, 0x1000)
+		while self.offset < addr:
+			n = min(addr - self.offset, len(block))
+			self.sink.write(block[:n])
+			self.offset += n
+
+	def write(self, addr, data):
+		data = memoryview(data)
+		if addr < self.start:
+			data = data[self.start - addr:]
+			addr = self.start
+		if self.end is not None:
+			data = data[:max(0, self.end - addr)]
+		if not data:
+			return
+		if addr < self.offset:
+			raise Exception(f"Out-of-order write at ${addr:04x}, already written up to ${self.offset:04x}")
+		self.pad_to(addr)
+		self.sink.write(data)
+		self.offset += len(data)
+
+	def close(self):
+		if self.end is not None:
+			self.pad_to(self.end)
+
+
+class RecordWriter(Writer):
+	"""Base class for text formats that split data into fixed-size records"""
+
+	def __init__(self, sink, record_size=16):
+		super().__init__(sink)
+		self.record_size = record_size
+		self.record_addr = None
+		self.record = bytearray()
+
+	def write(self, addr, data):
+		data = memoryview(data)
+		if self.record and addr != self.record_addr + len(self.record):
+			self.flush()
+		while data:
+			if not self.record:
+				self.record_addr = addr
+			# records never straddle a 64K boundary
+			space = min(self.record_size - len(self.record), 0x10000 - (addr & 0xffff))
+			self.record += data[:space]
+			data = data[space:]
+			addr += space
+			if len(self.record) == self.record_size or not addr & 0xffff:
+				self.flush()
+
+	def flush(self):
+		if self.record:
+			self.write_record(self.record_addr, bytes(self.record))
+			self.record.clear()
+
+	@abstractmethod
+	def write_record(self, addr, data):
+		pass
+
+
+class IHexWriter(RecordWriter):
+	"""Intel HEX, with extended linear address records for data above 64K"""
+
+	def __init__(self, sink, record_size=16):
+		super().__init__(sink, record_size)
+		self.upper = 0
+
+	def emit(self, rectype, addr, data=b""):
+		record = bytes([len(data), addr >> 8, addr & 0xff, rectype]) + data
+		checksum = -sum(record) & 0xff
+		self.sink.write(f":{record.hex().upper()}{checksum:02X}\n".encode())
+
+	def write_record(self, addr, data):
+		if addr >> 16 != self.upper:
+			self.upper = addr >> 16
+			self.emit(0x04, 0, self.upper.to_bytes(2, "big"))
+		self.emit(0x00, addr & 0xffff, data)
+
+	def close(self):
+		self.flush()
+		self.emit(0x01, 0)
+
+
+class SRecWriter(RecordWriter):
+	"""Motorola S-record. Uses S1/S9 records, or S2/S8 if `address_bytes` is 3
+	(for images bigger than 64K)"""
+
+	def __init__(self, sink, record_size=16, header=b"p65a", entry=0, address_bytes=2):
+		super().__init__(sink, record_size)
+		if address_bytes not in (2, 3):
+			raise Exception("S-record addresses must be 2 or 3 bytes")
+		self.address_bytes = address_bytes
+		self.entry = entry
+		self.count = 0
+		self.emit(0, 0, header, 2)
+
+	def emit(self, rectype, addr, data=b"", address_bytes=None):
+		address_bytes = address_bytes or self.address_bytes
+		record = bytes([address_bytes + len(data) + 1]) + addr.to_bytes(address_bytes, "big") + data
+		checksum = ~sum(record) & 0xff
+		self.sink.write(f"S{rectype}{record.hex().upper()}{checksum:02X}\n".encode())
+
+	def write_record(self, addr, data):
+		self.emit(self.address_bytes - 1, addr, data)
+		self.count += 1
+
+	def close(self):
+		self.flush()
+		if self.count <= 0xffff:
+			self.emit(5, self.count, address_bytes=2)
+		self.emit(11 - self.address_bytes, self.entry)
+
+
+class CBMPrgWriter(BinWriter):
+	"""Commodore PRG file: a little-endian load address followed by raw data"""
+
+	def __init__(self, sink, load_addr, end=None, fill=0):
+		super().__init__(sink, load_addr, end, fill)
+		sink.write(load_addr.to_bytes(2, "little"))
+
+
+class INESWriter(BinWriter):
+	"""iNES (NES cartridge) image. The PRG ROM is mapped so that it ends at
+	$ffff, and CHR ROM data can be appended with write_chr() after the PRG
+	data has been written."""
+
+	def __init__(self, sink, prg_banks=1, chr_banks=0, mapper=0, vertical_mirroring=False, battery=False, fill=0xff):
+		prg_size = prg_banks * 0x4000
+		if not 0 < prg_size <= 0x8000:
+			raise Exception("Only 16K or 32K of PRG ROM can be mapped at once")
+		super().__init__(sink, 0x10000 - prg_size, 0x10000, fill)
+		self.chr_size = chr_banks * 0x2000
+		self.chr_written = 0
+		flags6 = (mapper & 0x0f) << 4 | battery << 1 | vertical_mirroring
+		flags7 = mapper & 0xf0
+		sink.write(b"NES\x1a" + bytes([prg_banks, chr_banks, flags6, flags7]) + bytes(8))
+
+	def write_chr(self, data):
+		if self.offset < self.end:
+			self.pad_to(self.end)
+		if self.chr_written + len(data) > self.chr_size:
+			raise Exception("Too much CHR data")
+		self.sink.write(data)
+		self.chr_written += len(data)
+
+	def close(self):
+		super().close()
+		if self.chr_written < self.chr_size:
+			self.sink.write(bytes([self.fill]) * (self.chr_size - self.chr_written))
+			self.chr_written = self.chr_size
@@ -0,0 +1,113 @@
+"""
+An execution profiler for the emulator in p65a.emu.
+
+Executed cycles and instructions are attributed to whichever label the PC
+falls under (a label "owns" every address up to the next label), giving a
+flat profile. JSR/RTS pairs are tracked to build a call graph, with the
+inclusive cost of each call charged to its callee and to the caller-callee
+edge.
+"""
+
+from bisect import bisect_right
+
+JSR_OPCODE = 0x20
+RTS_OPCODE = 0x60
+
+
+class Profiler:
+	def __init__(self, cpu, labels):
+		self.cpu = cpu
+
+		# where several labels share an address, the first one defined wins
+		by_addr = {}
+		for name in labels:
+			by_addr.setdefault(labels[name], name)
+		self.label_addrs = sorted(by_addr)
+		self.label_names = [by_addr[addr] for addr in self.label_addrs]
+		self.label_cache = {}
+
+		self.cycles = {}        # label -> cycles spent at addresses under it
+		self.instructions = {}  # label -> instructions executed under it
+		self.calls = {}         # (caller, callee) -> [count, inclusive cycles]
+		self.inclusive = {}     # callee -> inclusive cycles over all calls
+		self.stack = []         # (caller, callee, sp after the JSR, cycles at entry)
+
+	def label_of(self, addr):
+		try:
+			return self.label_cache[addr]
+		except KeyError:
+			i = bisect_right(self.label_addrs, addr) - 1
+			name = self.label_names[i] if i >= 0 else f"${addr:04x}"
+			self.label_cache[addr] = name
+			return name
+
+	def current_routine(self):
+		return self.stack[-1][1] if self.stack else "<top>"
+
+	def run(self, until=None, max_cycles=None, max_instructions=None):
+		"""Like CPU.run(), but profiles each instruction as it goes"""
+		cpu = self.cpu
+		dispatch = cpu.dispatch
+		mem = cpu.mem
+		cycles = self.cycles
+		instructions = self.instructions
+		label_cache = self.label_cache
+		start = cpu.cycles
+		limit = float("inf") if max_cycles is None else start + max_cycles
+		remaining = -1 if max_instructions is None else max_instructions
+		count = 0
+		while cpu.pc != until and cpu.cycles < limit and count != remaining:
+			pc = cpu.pc
+			opcode = mem[pc]
+			before = cpu.cycles
+			if opcode == RTS_OPCODE:
+				# only treat it as a return if it pops what a JSR pushed,
+				# so that RTS-as-jump tricks don't confuse the call stack
+				if self.stack and cpu.sp == self.stack[-1][2]:
+					caller, callee, _, entry = self.stack.pop()
+					dispatch[opcode]()
+					self.leave(caller, callee, cpu.cycles - entry)
+				else:
+					dispatch[opcode]()
+			else:
+				dispatch[opcode]()
+				if opcode == JSR_OPCODE:
+					self.stack.append((self.current_routine(), self.label_of(cpu.pc), cpu.sp, before))
+			name = label_cache[pc] if pc in label_cache else self.label_of(pc)
+			cycles[name] = cycles.get(name, 0) + cpu.cycles - before
+			instructions[name] = instructions.get(name, 0) + 1
+			count += 1
+		cpu.instructions += count
+		return cpu.cycles - start
+
+	def leave(self, caller, callee, spent):
+		edge = self.calls.setdefault((caller, callee), [0, 0])
+		edge[0] += 1
+		edge[1] += spent
+		self.inclusive[callee] = self.inclusive.get(callee, 0) + spent
+
+	def flat_profile(self):
+		"""Return (label, cycles, instructions) tuples, hottest first"""
+		return sorted(
+			((name, n, self.instructions[name]) for name, n in self.cycles.items()),
+			key=lambda row: -row[1]
+		)
+
+	def call_graph(self):
+		"""Return (caller, callee, calls, inclusive cycles) tuples, most
+		expensive first. Calls that haven't returned yet aren't counted."""
+		return sorted(
+			((caller, callee, n, spent) for (caller, callee), (n, spent) in self.calls.items()),
+			key=lambda row: -row[3]
+		)
+
+	def report(self):
+		total = sum(self.cycles.values()) or 1
+		lines = [f"{'cycles':>10} {'%':>6} {'instrs':>10}  label"]
+		for name, n, instrs in self.flat_profile():
+			lines.append(f"{n:>10} {100 * n / total:>6.2f} {instrs:>10}  {name}")
+		lines.append("")
+		lines.append(f"{'calls':>10} {'incl.':>10} {'avg':>8}  caller -> callee")
+		for caller, callee, n, spent in self.call_graph():
+			lines.append(f"{n:>10} {spent:>10} {spent / n:>8.1f}  {caller} -> {callee}")
+		return "\n".join(lines)
@@ -1,36 +1,114 @@
 import operator
+import weakref
 from abc import ABC, abstractmethod
+from collections.abc import MutableMapping
+
+
+# Operators that can be emitted as plain Python syntax when compiling.
+# Anything else gets bound into the compiled function's namespace.
+BINARY_OPERATORS = {
+	operator.add: "+",
+	operator.sub: "-",
+	operator.mul: "*",
+	operator.floordiv: "//",
+	operator.mod: "%",
+	operator.rshift: ">>",
+	operator.lshift: "<<",
+	operator.and_: "&",
+	operator.or_: "|",
+	operator.xor: "^",
+}
+
+UNARY_OPERATORS = {
+	operator.neg: "-",
+	operator.pos: "+",
+	operator.invert: "~",
+}
+
+# Byte selectors, for lo()/hi()/bank(). Whatever they're applied to, the
+# result is just a number, so it doesn't keep the operand's type.
+def lo_byte(value):
+	return value & 0xff
+
+def hi_byte(value):
+	return value >> 8 & 0xff
+
+def bank_byte(value):
+	return value >> 16 & 0xff
+
+UNTYPED_OPERATORS = {lo_byte, hi_byte, bank_byte}
+
+# Subtrees nested deeper than this are compiled separately and called,
+# to stay clear of the Python parser's nesting limits.
+MAX_INLINE_DEPTH = 32
+
+# Expressions are walked node by node until they've been evaluated this many
+# times, and compiled after that. Compiling costs about as much as this many
+# walks of the same tree.
+COMPILE_THRESHOLD = 40
+
+
+# When enabled, structurally identical nodes built through the make()
+# constructors (and therefore the operator overloads) are shared. Entries are
+# weakly referenced, so nodes still get freed once nothing else uses them.
+intern_table = None
+
+
+def enable_interning():
+	global intern_table
+	if intern_table is None:
+		intern_table = weakref.WeakValueDictionary()
+
+
+def disable_interning():
+	global intern_table
+	intern_table = None
+
+
+def intern(key, node):
+	"""Return the existing node for `key` if there is one, else store `node`.
+	Keys refer to child nodes by id(), which is safe because each entry keeps
+	its children alive."""
+	if intern_table is None:
+		return node
+	return intern_table.setdefault(key, node)
+
+
+def resolve(value, symbols):
+	"""Evaluate a symbol table entry that isn't already a plain int."""
+	return Expression.cast(value).evaluate(symbols)
 
 
 class Expression(ABC):
-	type = None
+	# there can be a lot of these, so they don't get a __dict__
+	__slots__ = ("type", "_compiled", "_evaluations", "__weakref__")
 
 	@staticmethod
 	def cast(value):
 		if isinstance(value, Expression):
 			return value
-		return Literal(value)
+		return Literal.make(value)
 
 	def __mul__(self, other):
-		return BinaryOp(operator.mul, self, other)
+		return BinaryOp.make(operator.mul, self, other)
 
 	def __add__(self, other):
-		return BinaryOp(operator.add, self, other)
+		return BinaryOp.make(operator.add, self, other)
 
 	def __sub__(self, other):
-		return BinaryOp(operator.sub, self, other)
+		return BinaryOp.make(operator.sub, self, other)
 
 	def __neg__(self):
-		return UnaryOp(operator.neg, self)
+		return UnaryOp.make(operator.neg, self)
 
 	def __rshift__(self, other):
-		return BinaryOp(operator.rshift, self, other)
+		return BinaryOp.make(operator.rshift, self, other)
 
 	def __lshift__(self, other):
-		return BinaryOp(operator.lshift, self, other)
+		return BinaryOp.make(operator.lshift, self, other)
 
 	def __and__(self, other):
-		return BinaryOp(operator.and_, self, other)
+		return BinaryOp.make(operator.and_, self, other)
 
 	# this is a hack to allow LDA(foo[X]) syntax etc.
 	def __getitem__(self, item):
@@ -42,24 +120,186 @@ class Expression(ABC):
 	def __call__(self):
 		return self.type(self)()
 
-	@abstractmethod
 	def evaluate(self, symbols):
 		"""`symbols` should be a dictionary mapping symbols to values
 		(which may or may not be expressions themselves).
-		Should return a numeric value"""
+		Returns a numeric value"""
+		compiled = self._compiled
+		if compiled is not None:
+			return compiled(symbols)
+		# most expressions are only evaluated a handful of times (once per
+		# layout pass, then once to encode), which is far too few to pay
+		# for compiling them, so only the ones that keep coming back get it
+		self._evaluations += 1
+		if self._evaluations > COMPILE_THRESHOLD:
+			return self.compile()(symbols)
+		return self.walk(symbols)
+
+	def walk(self, symbols):
+		"""Evaluate the tree node by node, without compiling or recursing"""
+		values = []
+		stack = [self]
+		while stack:
+			node = stack.pop()
+			kind = type(node)
+			if kind is tuple:
+				op, arity = node
+				if arity == 2:
+					right = values.pop()
+					values[-1] = op(values[-1], right)
+				else:
+					values[-1] = op(values[-1])
+			elif kind is Literal:
+				values.append(node.value)
+			elif node._compiled is not None or kind is Symbol:
+				values.append(node.evaluate(symbols))
+			elif kind is BinaryOp:
+				stack += ((node.operator, 2), node.right, node.left)
+			elif kind is UnaryOp:
+				stack += ((node.operator, 1), node.operand)
+			else:
+				values.append(node.evaluate(symbols))
+		return values[0]
+
+	def compile(self):
+		"""Lower the whole tree into a single Python function of `symbols`.
+		The result is cached on the node, so it only gets built once."""
+		if self._compiled is None:
+			# very deep trees get split into several functions - build the
+			# deepest ones first so that building the source never recurses far
+			cuts = []
+			stack = [(self, 0)]
+			while stack:
+				node, depth = stack.pop()
+				if depth > MAX_INLINE_DEPTH:
+					cuts.append(node)
+					depth = 0
+				stack.extend((child, depth + 1) for child in node.children())
+			for node in reversed(cuts):
+				node._compile()
+			self._compile()
+		return self._compiled
+
+	def _compile(self):
+		if self._compiled is None:
+			env = {"resolve": resolve}
+			body = self.source(env)
+			self._compiled = eval(f"lambda symbols: {body}", env)
+
+	def __getstate__(self):
+		# compiled functions can't be pickled, but are cheap to rebuild
+		return {
+			name: getattr(self, name)
+			for cls in type(self).__mro__
+			for name in getattr(cls, "__slots__", ())
+			if name not in ("_compiled", "_evaluations", "__weakref__")
+		}
+
+	def __setstate__(self, state):
+		self._compiled = None
+		self._evaluations = 0
+		for name, value in state.items():
+			setattr(self, name, value)
+
+	def children(self):
+		return ()
+
+	def key(self):
+		"""Return a hashable key describing the structure of this expression.
+		Structurally identical expressions have equal keys. The key is flat
+		(every node in prefix order, which is unambiguous because each kind of
+		node has a fixed number of children), so that even very deep ones can
+		be built, hashed and compared without recursion."""
+		if type(self) is Symbol:
+			return "Symbol", self.name
+		key = []
+		stack = [self]
+		while stack:
+			node = stack.pop()
+			kind = type(node)
+			if kind is Literal:
+				key += ("Literal", node.value)
+			elif kind is Symbol:
+				key += ("Symbol", node.name)
+			elif kind is BinaryOp:
+				key += ("BinaryOp", node.operator.__name__)
+				stack += (node.right, node.left)
+			elif kind is UnaryOp:
+				key += ("UnaryOp", node.operator.__name__)
+				stack.append(node.operand)
+			else:
+				op = getattr(node, "operator", None)
+				key += (kind.__name__, getattr(op, "__name__", repr(op)))
+				stack.extend(reversed(node.children()))
+		return tuple(key)
+
+	def symbols(self):
+		"""Return the set of symbol names this expression refers to"""
+		names = set()
+		stack = [self]
+		while stack:
+			node = stack.pop()
+			if type(node) is Symbol:
+				names.add(node.name)
+			stack.extend(node.children())
+		return names
+
+	def inline(self, env, depth):
+		"""Like source(), but falls back to calling a separately compiled
+		function once the tree gets too deep"""
+		if depth > MAX_INLINE_DEPTH:
+			name = f"_f{len(env)}"
+			self._compile()
+			env[name] = self._compiled
+			return f"{name}(symbols)"
+		return self.source(env, depth)
+
+	@abstractmethod
+	def source(self, env, depth=0):
+		"""Return a Python expression (as a string) that computes the value of
+		this node from `symbols`. Any objects it refers to by name should be
+		added to the `env` dict."""
 
 
 class UnaryOp(Expression):
+	__slots__ = ("operator", "operand")
+
 	def __init__(self, operator, operand):
 		self.operator = operator
 		self.operand = Expression.cast(operand)
-		self.type = self.operand.type
+		self.type = None if operator in UNTYPED_OPERATORS else self.operand.type
+		self._compiled = None
+		self._evaluations = 0
+
+	@classmethod
+	def make(cls, operator, operand):
+		"""Like the constructor, but folds constants and interns the result"""
+		operand = Expression.cast(operand)
+		if type(operand) is Literal:
+			return Literal.make(operator(operand.value), None if operator in UNTYPED_OPERATORS else operand.type)
+		return intern((cls, operator, id(operand)), cls(operator, operand))
 
 	def evaluate(self, symbols):
-		return self.operator(self.operand.evaluate(symbols))
+		# an op on a leaf is no quicker compiled than evaluated directly
+		if type(self.operand) in (Literal, Symbol):
+			return self.operator(self.operand.evaluate(symbols))
+		return super().evaluate(symbols)
+
+	def children(self):
+		return (self.operand,)
+
+	def source(self, env, depth=0):
+		operand = self.operand.inline(env, depth + 1)
+		if self.operator in UNARY_OPERATORS:
+			return f"({UNARY_OPERATORS[self.operator]}{operand})"
+		name = f"_f{len(env)}"
+		env[name] = self.operator
+		return f"{name}({operand})"
 
 
 class BinaryOp(Expression):
+	__slots__ = ("operator", "left", "right")
+
 	def __init__(self, operator, left, right):
 		self.operator = operator
 		self.left = Expression.cast(left)
@@ -67,31 +307,216 @@ class BinaryOp(Expression):
 
 		# propagate type info if present, giving priority to the type of the lval
 		self.type = self.right.type if self.left.type is None else self.left.type
+		self._compiled = None
+		self._evaluations = 0
+
+	@classmethod
+	def make(cls, operator_, left, right):
+		"""Like the constructor, but folds constants and interns the result"""
+		left = Expression.cast(left)
+		right = Expression.cast(right)
+		if type(left) is Literal and type(right) is Literal:
+			type_ = right.type if left.type is None else left.type
+			return Literal.make(operator_(left.value, right.value), type_)
+
+		# (x + a) - b  =>  x + (a - b)
+		if operator_ in (operator.add, operator.sub) and type(right) is Literal \
+				and type(left) is BinaryOp and type(left.right) is Literal \
+				and left.operator in (operator.add, operator.sub):
+			offset = left.right.value if left.operator is operator.add else -left.right.value
+			offset = offset + right.value if operator_ is operator.add else offset - right.value
+			# the folded literal stands in for both of the old ones, type-wise
+			type_ = right.type if left.right.type is None else left.right.type
+			if offset < 0:
+				return cls.make(operator.sub, left.left, Literal.make(-offset, type_))
+			return cls.make(operator.add, left.left, Literal.make(offset, type_))
+
+		return intern((cls, operator_, id(left), id(right)), cls(operator_, left, right))
 
 	def evaluate(self, symbols):
-		return self.operator(
-			self.left.evaluate(symbols),
-			self.right.evaluate(symbols)
-		)
+		# likewise for UnaryOp.evaluate(), e.g. for the common `label + offset`
+		if type(self.left) in (Literal, Symbol) and type(self.right) in (Literal, Symbol):
+			return self.operator(self.left.evaluate(symbols), self.right.evaluate(symbols))
+		return super().evaluate(symbols)
+
+	def children(self):
+		return (self.left, self.right)
+
+	def source(self, env, depth=0):
+		left = self.left.inline(env, depth + 1)
+		right = self.right.inline(env, depth + 1)
+		if self.operator in BINARY_OPERATORS:
+			return f"({left} {BINARY_OPERATORS[self.operator]} {right})"
+		name = f"_f{len(env)}"
+		env[name] = self.operator
+		return f"{name}({left}, {right})"
 
 
 class Literal(Expression):
+	__slots__ = ("value",)
+
 	def __init__(self, value, type=None):
 		self.value = int(value)  # we only support int literals, for now
 		self.type = type
+		self._compiled = None
+		self._evaluations = 0
+
+	@classmethod
+	def make(cls, value, type=None):
+		value = int(value)
+		return intern((cls, value, type), cls(value, type))
 
 	def evaluate(self, symbols):
 		_ = symbols  # unused
 		return self.value
 
+	def source(self, env, depth=0):
+		return repr(self.value)
+
 
 class Symbol(Expression):
+	__slots__ = ("name",)
+
 	def __init__(self, name, type=None):
 		self.name = name
 		self.type = type
+		self._compiled = None
+		self._evaluations = 0
+
+	@classmethod
+	def make(cls, name, type=None):
+		return intern((cls, name, type), cls(name, type))
 
 	def evaluate(self, symbols):
-		return Expression.cast(symbols[self.name]).evaluate(symbols)
+		# a bare symbol is common enough (and cheap enough to look up) that
+		# it isn't worth keeping a compiled function around for each one
+		value = symbols[self.name]
+		return value if type(value) is int else resolve(value, symbols)
+
+	def source(self, env, depth=0):
+		# the common case is a plain int, which we can use without a call
+		var = f"_v{len(env)}"
+		env[var] = None  # reserve the name
+		return f"({var} if type({var} := symbols[{self.name!r}]) is int else resolve({var}, symbols))"
+
+
+def lo(value):
+	"""The low byte of an address (or any value), e.g. for LDA(lo(label))"""
+	return UnaryOp.make(lo_byte, value)
+
+def hi(value):
+	"""The high byte of an address (bits 8-15)"""
+	return UnaryOp.make(hi_byte, value)
+
+def bank(value):
+	"""The bank byte of a (24-bit) address (bits 16-23)"""
+	return UnaryOp.make(bank_byte, value)
+
+
+class SymbolTable(MutableMapping):
+	"""A drop-in replacement for a plain dict of symbols.
+
+	Definitions may be ints or Expressions referring to other symbols. Looking
+	a symbol up resolves it (and anything it depends on) once, in dependency
+	order, and caches the concrete value. Redefining a symbol only throws away
+	the cached values of the symbols that depend on it."""
+
+	def __init__(self, definitions=()):
+		self.definitions = {}
+		self.resolved = {}
+		self.dependencies = {}  # name -> names its definition refers to
+		self.dependents = {}    # name -> names whose definitions refer to it
+		self.update(definitions)
+
+	def __getitem__(self, name):
+		try:
+			return self.resolved[name]
+		except KeyError:
+			return self.resolve(name)
+
+	def __setitem__(self, name, value):
+		if name in self.definitions:
+			old = self.definitions[name]
+			if old is value or (type(old) is int and type(value) is int and old == value):
+				return
+			self._forget(name)
+		self.definitions[name] = value
+		deps = () if type(value) is int else tuple(Expression.cast(value).symbols())
+		self.dependencies[name] = deps
+		for dep in deps:
+			self.dependents.setdefault(dep, set()).add(name)
+
+	def __delitem__(self, name):
+		self._forget(name)
+		del self.definitions[name]
+		del self.dependencies[name]
+
+	def __iter__(self):
+		return iter(self.definitions)
+
+	def __len__(self):
+		return len(self.definitions)
+
+	def __contains__(self, name):
+		return name in self.definitions
+
+	def __repr__(self):
+		return f"SymbolTable({self.definitions!r})"
+
+	def _forget(self, name):
+		for dep in self.dependencies[name]:
+			self.dependents[dep].discard(name)
+		self.invalidate(name)
+
+	def invalidate(self, name):
+		"""Drop the cached value of `name` and of everything that depends on it"""
+		stack = [name]
+		while stack:
+			name = stack.pop()
+			self.resolved.pop(name, None)
+			# anything unresolved can't have resolved dependents, so we only
+			# need to keep going through the ones that are still cached
+			stack.extend(n for n in self.dependents.get(name, ()) if n in self.resolved)
+
+	def resolve(self, name):
+		"""Resolve `name` and its dependencies, depth-first, without recursion"""
+		resolved = self.resolved
+		if name in resolved:
+			return resolved[name]
+		path = [name]
+		on_path = {name}
+		pending = [iter(self.dependencies[name])] if name in self.definitions else None
+		if pending is None:
+			raise KeyError(name)
+		while path:
+			for dep in pending[-1]:
+				if dep in resolved:
+					continue
+				if dep in on_path:
+					cycle = path[path.index(dep):] + [dep]
+					raise Exception(f"Circular symbol definition: {' -> '.join(cycle)}")
+				if dep not in self.definitions:
+					raise KeyError(dep)
+				path.append(dep)
+				on_path.add(dep)
+				pending.append(iter(self.dependencies[dep]))
+				break
+			else:
+				current = path.pop()
+				on_path.discard(current)
+				pending.pop()
+				value = self.definitions[current]
+				if type(value) is not int:
+					value = Expression.cast(value).evaluate(self)
+				resolved[current] = value
+		return resolved[name]
+
+	def resolve_all(self):
+		"""Resolve every symbol, returning a plain dict of concrete values"""
+		for name in self.definitions:
+			if name not in self.resolved:
+				self.resolve(name)
+		return dict(self.resolved)
 
 
 class SymbolFactory:
@@ -102,7 +527,7 @@ class SymbolFactory:
 		# we can't just do self.type because that'd call __getattribute__
 		# and then we'd get infinite recursion...
 		type_ = object.__getattribute__(self, "type")
-		return Symbol(name, type=type_)
+		return Symbol.make(name, type=type_)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,53 @@
+from p65a import *
+from p65a.banking import Banking
+from p65a.emu import CPU
+
+MAPPER = 0x5000
+
+
+def run(banking, fixed):
+	prog, labels = banking.build(fixed, 0xe000)
+	cpu = CPU()
+	cpu.load(assemble(prog, labels))
+	roms = {bank.number: bank.assemble() for bank in banking.banks}
+	cpu.write_hooks[MAPPER] = lambda n: cpu.mem.__setitem__(slice(0x8000, 0x8100), roms[n])
+	cpu.pc = labels["start"]
+	sp = cpu.sp
+	cpu.run(until=labels["halt"], max_cycles=100000)
+	return cpu, sp, labels
+
+
+def banking():
+	return Banking(4, 0x8000, 0x100, lambda n: [LDA(n), STA(Addr(MAPPER))])
+
+
+def test_cross_bank_jsr_restores_bank():
+	b = banking()
+	b.add("a", [LDX(0), lbl.a_loop, JSR(lbl.b), INX(), CPX(3), BNE(lbl.a_loop), RTS()], bank=0)
+	b.add("b", [INC(Addr(0x10)), RTS()], bank=1)
+	cpu, sp, labels = run(b, [Org(0xc000), lbl.start, JSR(lbl.a), lbl.halt, JMP(lbl.halt)])
+	assert cpu.mem[0x10] == 3
+	assert cpu.sp == sp
+	assert "far_b_from_0" in labels
+
+
+def test_cross_bank_jmp_doesnt_use_stack():
+	b = banking()
+	b.add("a", [INC(Addr(0x11)), LDA(Addr(0x11)), CMP(50), BNE(lbl.a_next), RTS(), lbl.a_next, JMP(lbl.b)], bank=0)
+	b.add("b", [INC(Addr(0x10)), JMP(lbl.a)], bank=1)
+	cpu, sp, labels = run(b, [Org(0xc000), lbl.start, JSR(lbl.a), lbl.halt, JMP(lbl.halt)])
+	assert (cpu.mem[0x10], cpu.mem[0x11]) == (49, 50)
+	assert cpu.sp == sp
+	assert {"far_a", "far_b"} <= labels.keys()
+	assert not any(name.startswith("far_") and "_from_" in name for name in labels)
+
+
+def test_indirect_jmp_isnt_redirected():
+	b = banking()
+	b.add("a", [JMP([lbl.b])], bank=0)
+	b.add("b", [RTS()], bank=1)
+	assert list(b.calls(b.routines["a"])) == []
+	b.pack()
+	needed = set()
+	assert b.redirect(b.routines["a"], b.placement["a"], needed) == b.routines["a"]
+	assert needed == set()
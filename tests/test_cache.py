@@ -0,0 +1,129 @@
+import os
+
+from p65a import *
+from p65a.cache import BuildCache
+
+
+def sections(n):
+	prog = []
+	for i in range(n):
+		prog += [Org(0x100 + i * 16), getattr(lbl, f"s{i}"), NOP(), LDA(i & 0xff)]
+	return prog
+
+
+def calls():
+	return [
+		Org(0x1000), lbl.main, JSR(lbl.sub), STA(lbl.var), RTS(),
+		Org(0x2000), lbl.sub, LDA(lo(lbl.main)), RTS(),
+		Org(0x80), lbl.var, Db([0]),
+	]
+
+
+def expected(program):
+	prog, labels = concretise(program)
+	return bytes(assemble(prog, labels)[0:0x10000]), labels
+
+
+def test_cache_matches_assemble(tmp_path):
+	program = sections(50)
+	data, labels = expected(program)
+	cache = BuildCache(str(tmp_path))
+	for hits in (0, 50):
+		image, built = cache.build(program)
+		assert bytes(image[0:0x10000]) == data
+		assert dict(built) == dict(labels)
+		assert cache.hits == hits
+
+
+def test_cache_skips_layout_on_hit(tmp_path):
+	cache = BuildCache(str(tmp_path))
+	cache.build(calls())
+	program = calls()
+	# a hit never looks at the instructions beyond hashing them
+	program[1:5] = [lbl.main, JSR(lbl.sub), STA(lbl.var), RTS()]
+	image, labels = cache.build(program)
+	assert cache.hits == 2  # the data-only section isn't worth caching
+	assert bytes(image[0:0x10000]) == expected(calls())[0]
+
+
+def test_cache_relays_out_changed_sections(tmp_path):
+	cache = BuildCache(str(tmp_path))
+	cache.build(calls())
+	program = calls()
+	program[6:6] = [NOP()]  # moves sub, which main calls
+	image, labels = cache.build(program)
+	data, expected_labels = expected(program)
+	assert bytes(image[0:0x10000]) == data
+	assert labels["sub"] == expected_labels["sub"] == 0x2001
+
+
+def test_cache_moved_dependency(tmp_path):
+	cache = BuildCache(str(tmp_path))
+	cache.build(calls())
+	program = calls()
+	program[-1] = Db([0, 0])
+	program[-3] = Org(0x100)  # var leaves the zero page, so main's STA grows
+	image, labels = cache.build(program)
+	assert bytes(image[0:0x10000]) == expected(program)[0]
+
+
+def test_cache_duplicate_label(tmp_path):
+	cache = BuildCache(str(tmp_path))
+	cache.build(calls())
+	try:
+		cache.build(calls() + [Org(0x3000), lbl.sub, RTS()])
+	except Exception as e:
+		assert "defined more than once" in str(e)
+	else:
+		assert False
+
+
+def test_cache_eviction(tmp_path):
+	cache = BuildCache(str(tmp_path), max_size=3000)
+	cache.build(sections(200))
+	assert cache.size <= 3000
+	assert sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(tmp_path) for f in files) == cache.size
+
+
+def test_cache_entry_vanishing(tmp_path):
+	cache = BuildCache(str(tmp_path))
+	cache.build(sections(1))
+	for dirpath, _, files in os.walk(tmp_path):
+		for name in files:
+			os.remove(os.path.join(dirpath, name))  # as if another build evicted it
+	image, labels = cache.build(sections(1))
+	assert labels["s0"] == 0x100
+	cache.evict()
+
+
+def test_table_follows_helpers(tmp_path):
+	cache = BuildCache(str(tmp_path))
+	namespace = {"cache": cache}
+	helper = "def helper(i):\n\treturn i * {}\n"
+	table = "@cache.table\ndef squares(n):\n\treturn [helper(i) & 0xff for i in range(n)]\n"
+	exec(helper.format(2) + table, namespace)
+	assert namespace["squares"](4) == bytes([0, 2, 4, 6])
+	exec(helper.format(3) + table, namespace)
+	assert namespace["squares"](4) == bytes([0, 3, 6, 9])
+	assert cache.hits == 0
+
+
+def test_table_version(tmp_path):
+	cache = BuildCache(str(tmp_path))
+	results = iter([b"a", b"b"])
+	for version, expected in ((1, b"a"), (1, b"a"), (2, b"b")):
+		@cache.table(version=version)
+		def table():
+			return next(results)
+		assert table() == expected
+
+
+def test_incbin_key_follows_contents(tmp_path):
+	path = tmp_path / "data.bin"
+	path.write_bytes(b"abcd")
+	before = Incbin(str(path)).key()
+	assert Incbin(str(path)).key() == before
+	stat = os.stat(path)
+	path.write_bytes(b"abce")
+	os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))  # same size and mtime
+	assert Incbin(str(path)).key() != before
@@ -0,0 +1,18 @@
+import pytest
+
+from p65a.image import Image
+
+
+def test_negative_index():
+	img = Image([(0xfffc, b"\x00\x10\x34\x12")], fill=0xff)
+	assert img[-1] == 0x12
+	assert img[-4] == 0x00
+	assert img[-0x10000] == 0xff
+
+
+def test_index_out_of_range():
+	img = Image([(0, b"\x01")])
+	with pytest.raises(IndexError):
+		img[0x10000]
+	with pytest.raises(IndexError):
+		img[-0x10001]
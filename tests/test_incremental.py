@@ -0,0 +1,62 @@
+import pytest
+
+from p65a import *
+from p65a.incremental import Session
+
+
+def section(name, org, body):
+	return [Org(org), getattr(lbl, name), body, JSR(lbl.a), BNE(getattr(lbl, name)), RTS()]
+
+
+def build(*sections, keys=None, session=None):
+	session = session or Session()
+	prog, labels, image = session.assemble(list(sections), keys)
+	expected = assemble(*concretise(list(sections)))
+	assert image.segments == expected.segments
+	return session
+
+
+def test_same_objects_are_reused():
+	a = section("a", 0x1000, [NOP()] * 10)
+	b = section("b", 0x2000, [INX()] * 10)
+	session = build(a, b)
+	build(a, b, session=session)
+	assert session.laid_out == 0
+	assert session.reencoded == 0
+
+
+def test_edit_reencodes_dependents():
+	b = section("b", 0x2000, [INX()] * 10)
+	session = build(section("a", 0x1000, []), b)
+	build(section("a", 0x1001, []), b, session=session)
+	assert session.laid_out == 1
+	assert not session.relaid
+	# all of a, and the JSR to it in b, in place
+	assert session.reencoded == 3 + 1
+	assert session.reused == 12
+
+
+def test_regenerated_sections_match_by_structure_or_key():
+	session = build(section("a", 0x1000, [NOP()]), section("b", 0x2000, [INX()]))
+	build(section("a", 0x1000, [NOP()]), section("b", 0x2000, [INX()]), session=session)
+	assert session.laid_out == 0
+	build(section("a", 0x1000, [NOP()]), section("b", 0x2000, [INX()]), keys=["a", "b"], session=session)
+	assert session.laid_out == 2  # no keys were given last time
+	build(section("a", 0x1000, [NOP()]), section("b", 0x2000, [INY()]), keys=["a", "b2"], session=session)
+	assert session.laid_out == 1
+	with pytest.raises(Exception, match="keys"):
+		session.assemble([section("a", 0x1000, [])], ["a", "b"])
+
+
+def test_relays_out_when_a_branch_stops_reaching():
+	loop = section("b", 0x2000, [BNE(lbl.a)])
+	session = build(section("a", 0x2000 - 0x40, []), loop)
+	build(section("a", 0x2000 - 0x400, []), loop, session=session)
+	assert session.relaid
+
+
+def test_duplicate_labels():
+	a = section("a", 0x1000, [])
+	session = build(a)
+	with pytest.raises(Exception, match="defined more than once"):
+		session.assemble([a, section("a", 0x2000, [])])
@@ -0,0 +1,46 @@
+from p65a import *
+from p65a.instrument import Instrumentation
+
+
+def program():
+	return [Org(0x1000), lbl.start, LDA(lo(lbl.start)), LDX(1), Dw([lbl.start, 2]), JMP(lbl.start)]
+
+
+def test_counters():
+	instrument = Instrumentation()
+	prog, labels = concretise(program(), instrument=instrument)
+	assemble(prog, labels, instrument)
+	assert instrument.counters["symbolic_operands"] == 3
+	assert instrument.counters["bytes_emitted"] == 11
+	assert instrument.counters["symbol_lookups"] > 0
+	assert instrument.counters["evaluations"] > 0
+
+
+def test_timings_only():
+	events = []
+	instrument = Instrumentation(lambda *event: events.append(event), counting=False)
+	prog, labels = concretise(program(), instrument=instrument)
+	image = assemble(prog, labels, instrument)
+	assert instrument.counters == {}
+	assert {"layout", "assemble"} <= instrument.timings.keys()
+	assert all(event != "count" for event, _, _ in events)
+	assert bytes(image[0x1000:0x100b]) == bytes(assemble(*concretise(program()))[0x1000:0x100b])
+
+
+def test_evaluations_grow_with_layout_passes():
+	def counters(far):
+		# once the second branch is relaxed, the first no longer reaches
+		instrument = Instrumentation()
+		concretise([
+			Org(0x1000), BNE(lbl.near), BNE(lbl.far), Db(bytes(124)), lbl.near, Db(bytes(far)), lbl.far,
+		], instrument=instrument)
+		return instrument.counters
+	passes = lambda far: counters(far)["layout_passes"]
+	evaluations = lambda far: counters(far)["evaluations"]
+	assert passes(0) < passes(200)
+	assert 0 < evaluations(0) < evaluations(200)
+	# and they're counted as the expressions are evaluated, however deep
+	instrument = Instrumentation()
+	prog, labels = concretise([Org(0x1000), lbl.start, LDA(lo(lbl.start + 1) + 1), JMP(lbl.start)])
+	assemble(prog, labels, instrument)
+	assert instrument.counters["evaluations"] == 2
@@ -0,0 +1,63 @@
+import pytest
+
+from p65a import *
+
+
+def test_align():
+	prog, labels = concretise([Org(0x1001), NOP(), Align(0x100), lbl.table, Db([1, 2])])
+	assert labels["table"] == 0x1100
+
+
+def test_nopagecross_pads_to_next_page():
+	prog, labels = concretise([Org(0x10fa), NoPageCross(lbl.table, Db([0] * 20))])
+	assert labels["table"] == 0x1100
+
+
+def test_nopagecross_leaves_fitting_block_alone():
+	prog, labels = concretise([Org(0x1010), NoPageCross(lbl.table, Db([0] * 20))])
+	assert labels["table"] == 0x1010
+
+
+def test_nopagecross_with_align_inside():
+	# the block's size depends on the Align inside it, which depends on
+	# where the block ends up
+	prog, labels = concretise([
+		Org(0x10e0),
+		NoPageCross(lbl.blk, Db([1] * 4), Align(0x10), Db([2] * 0x18), lbl.blkend),
+	])
+	assert labels["blk"] >> 8 == (labels["blkend"] - 1) >> 8
+
+
+def test_nested_nopagecross():
+	prog, labels = concretise([
+		Org(0x10f0),
+		NoPageCross(lbl.outer, Db([1] * 4), NoPageCross(lbl.inner, Db([2] * 0x10)), Align(4), Db([3])),
+		lbl.end,
+	])
+	assert labels["outer"] >> 8 == (labels["end"] - 1) >> 8
+
+
+def test_nopagecross_too_big():
+	with pytest.raises(Exception, match="more than a page"):
+		concretise([NoPageCross(Db([0] * 300))])
+
+
+def test_place_packs_movable_blocks():
+	prog = [
+		Org(0x2000), NOP(), NOP(),
+		NoPageCross(lbl.a, Db([1] * 200), movable=True),
+		NoPageCross(lbl.b, Db([2] * 100), movable=True),
+		NoPageCross(lbl.c, Db([3] * 50), movable=True),
+		RTS(),
+	]
+	unplaced, _ = concretise(prog)
+	placed, labels = concretise(prog, place=True)
+	end = lambda p: p[-1].address + p[-1].length
+	assert end(placed) < end(unplaced)
+	for name, size in (("a", 200), ("b", 100), ("c", 50)):
+		assert labels[name] >> 8 == (labels[name] + size - 1) >> 8
+
+
+def test_aligned_index_has_no_page_penalty():
+	prog, labels = concretise([Org(0x1000), LDA(lbl.table[X]), Align(0x100), lbl.table, Db([0])])
+	assert prog[1].cycle_range(labels) == (4, 4)
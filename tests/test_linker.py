@@ -0,0 +1,45 @@
+import pytest
+
+from p65a import *
+from p65a.linker import Module, link, assemble_parallel
+
+
+def library(name, value):
+	return Module([
+		getattr(lbl, name), LDX(0),
+		lbl.loop, LDA(value), STA(Addr(0x200)), DEX(), BNE(lbl.loop), JMP(lbl.loop),
+		RTS(),
+	], name, exports=[name])
+
+
+def test_local_labels_dont_collide():
+	a, b = library("a", 1), library("b", 2)
+	image, labels = link([a, b], base=0x8000)
+	assert "loop" not in labels
+	assert labels["a"] == 0x8000 and labels["b"] == 0x8000 + len(a)
+	# each JMP goes to its own module's loop
+	jmp_a = bytes(image[0x8000 + len(a) - 4:0x8000 + len(a) - 1])
+	jmp_b = bytes(image[labels["b"] + len(b) - 4:labels["b"] + len(b) - 1])
+	assert jmp_a == bytes([0x4c]) + (labels["a"] + 2).to_bytes(2, "little")
+	assert jmp_b == bytes([0x4c]) + (labels["b"] + 2).to_bytes(2, "little")
+
+
+def test_exported_labels_still_collide():
+	with pytest.raises(Exception, match="Duplicate definition of symbol loop"):
+		link([Module([lbl.loop, RTS()], "a"), Module([lbl.loop, RTS()], "b")])
+
+
+def test_undefined_export():
+	with pytest.raises(Exception, match="exports undefined"):
+		Module([lbl.a, RTS()], "m", exports=["b"])
+
+
+def test_link_matches_whole_program():
+	program = [
+		Org(0x8000), lbl.start, LDA(Addr(lbl.data)), JSR(lbl.sub), JMP(lbl.start),
+		Org(0x9000), lbl.sub, LDX(lo(lbl.data)), LDY(hi(lbl.data)), RTS(),
+		Org(0xa000), lbl.data, Dw([lbl.start, lbl.sub]),
+	]
+	prog, labels = concretise(program)
+	image, linked = assemble_parallel(program, max_workers=1)
+	assert bytes(image[0x8000:0xa004]) == bytes(assemble(prog, labels)[0x8000:0xa004])
@@ -0,0 +1,67 @@
+import pytest
+
+from p65a import *
+from p65a.emu import CPU
+from p65a.optimize import optimize
+
+FLAGS = 0x83  # N, Z and C
+
+
+def keys(program):
+	return [item_key(item) for item in flatten(program)]
+
+
+def unchanged(program):
+	return keys(optimize(program)) == keys(program)
+
+
+@pytest.mark.parametrize("cls", [LSR, ASL])
+@pytest.mark.parametrize("n", range(1, 12))
+def test_long_shift_matches_emulator(cls, n):
+	def run(program):
+		prog, labels = concretise([Org(0x1000), program, RTS()])
+		cpu = CPU()
+		cpu.load(assemble(prog, labels))
+		results = []
+		for carry in (0, 1):
+			for value in range(256):
+				cpu.p = carry
+				cpu.call(0x1000, a=value)
+				results.append((cpu.a, cpu.p & FLAGS))
+		return results
+	shifts = [cls(A) for _ in range(n)]
+	assert unchanged(shifts) == (n < 6)
+	assert run(optimize(shifts)) == run(shifts)
+
+
+def test_long_shift_needs_an_unbroken_run():
+	assert unchanged([LSR(A), LSR(A), LSR(A), lbl.half, LSR(A), LSR(A), LSR(A)])
+	assert unchanged([LSR(zp.v) for _ in range(8)])
+	assert unchanged([LSR(A), ASL(A), LSR(A), ASL(A), LSR(A), ASL(A)])
+
+
+def test_lda_after_sta():
+	assert keys(optimize([STA(zp.v), LDA(zp.v), LDX(1)])) == keys([STA(zp.v), LDX(1)])
+	assert keys(optimize([STX(zp.v), LDX(zp.v), INY()])) == keys([STX(zp.v), INY()])
+	# something else could jump to the load
+	assert unchanged([STA(zp.v), lbl.load, LDA(zp.v), LDX(1)])
+	# the load's flags are still needed
+	assert unchanged([STA(zp.v), LDA(zp.v), BNE(lbl.load), lbl.load])
+	assert unchanged([STA(zp.v), LDA(zp.v), STA(zp.w)])
+	assert unchanged([STA(zp.v), LDA(zp.w), LDX(1)])
+
+
+def test_tail_call():
+	assert keys(optimize([JSR(lbl.f), RTS()])) == keys([JMP(lbl.f)])
+	assert unchanged([JSR(lbl.f), lbl.ret, RTS()])
+	assert unchanged([JSR(lbl.f), NOP(), RTS()])
+
+
+def test_jump_to_jump():
+	program = lambda first, second: [first, lbl.a, JMP(second), lbl.b, JMP(lbl.c)]
+	assert keys(optimize(program(JMP(lbl.a), lbl.b))) == keys(program(JMP(lbl.c), lbl.c))
+	assert keys(optimize(program(BNE(lbl.a), lbl.b))) == keys(program(BNE(lbl.c), lbl.c))
+	# not a jump straight away, or a jump to a pointer, or round in circles
+	assert unchanged([JMP(lbl.a), lbl.a, NOP(), JMP(lbl.b)])
+	assert unchanged([JMP([lbl.a]), lbl.a, JMP([lbl.b])])
+	assert unchanged([BNE(lbl.a), lbl.a, JMP(lbl.b), lbl.b, JMP(lbl.a)])
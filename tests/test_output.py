@@ -0,0 +1,50 @@
+import io
+
+import pytest
+
+from p65a import *
+from p65a.output import BinWriter, IHexWriter, RecordWriter, Writer
+
+
+class CountingSink(io.BytesIO):
+	def __init__(self):
+		super().__init__()
+		self.writes = 0
+
+	def write(self, data):
+		self.writes += 1
+		return super().write(data)
+
+
+def program():
+	return concretise([
+		Org(0x1000), [NOP() for _ in range(100)], RTS(),
+		Org(0x2000), lbl.table, Db(bytes(range(50))),
+	])
+
+
+def test_writers_are_abstract():
+	with pytest.raises(TypeError):
+		Writer(io.BytesIO())
+	with pytest.raises(TypeError):
+		RecordWriter(io.BytesIO())
+
+
+def test_write_program_writes_whole_runs():
+	prog, labels = program()
+	sink = CountingSink()
+	with BinWriter(sink, 0x1000, 0x2100) as w:
+		w.write_program(prog, labels)
+	assert sink.getvalue() == bytes(assemble(prog, labels)[0x1000:0x2100])
+	# two runs of code, plus padding before the second and after it
+	assert sink.writes == 4
+
+
+def test_write_program_matches_write_image():
+	prog, labels = program()
+	a, b = io.BytesIO(), io.BytesIO()
+	with IHexWriter(a) as w:
+		w.write_program(prog, labels)
+	with IHexWriter(b) as w:
+		w.write_image(assemble(prog, labels))
+	assert a.getvalue() == b.getvalue()
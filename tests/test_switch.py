@@ -0,0 +1,50 @@
+import pytest
+
+from p65a import *
+from p65a.emu import CPU
+from p65a.incremental import Session
+
+OUT = Literal(0x200, type=Addr)
+
+
+def dispatcher(values, table=None):
+	cases = {v: getattr(lbl, f"case{v}") for v in values}
+	program = [
+		Org(0x1000),
+		lbl.entry,
+		Switch(zp.sel, cases, table=table),
+		A <= 0xff, OUT <= A, RTS(),
+	]
+	for value, target in cases.items():
+		program += [target, A <= value, OUT <= A, RTS()]
+	return program + [Org(0x10), zp.sel]
+
+
+@pytest.mark.parametrize("table", [True, False])
+@pytest.mark.parametrize("values", [range(10), [1, 5, 9, 40, 41, 200, 255], [0]])
+def test_switch_dispatch(values, table):
+	prog, labels = concretise(dispatcher(values, table))
+	cpu = CPU()
+	cpu.load(assemble(prog, labels))
+	for selector in range(256):
+		cpu.mem[0x10] = selector
+		cpu.call(labels["entry"])
+		assert cpu.mem[0x200] == (selector if selector in values else 0xff)
+
+
+def test_switch_labels_are_deterministic():
+	names = lambda: {instr.name for instr in flatten(dispatcher(range(10))) if type(instr) is Symbol}
+	assert names() == names()
+
+
+def test_switch_rebuild_reuses_sections():
+	session = Session()
+	session.assemble([dispatcher(range(10)), Org(0x2000), NOP()])
+	session.assemble([dispatcher(range(10)), Org(0x2000), NOP()])
+	assert session.reencoded == 0
+
+
+def test_identical_switches_need_names():
+	switch = lambda: Switch(zp.sel, {0: lbl.a, 1: lbl.b})
+	with pytest.raises(Exception, match="defined more than once"):
+		concretise([switch(), switch(), lbl.a, lbl.b, Org(0x10), zp.sel])
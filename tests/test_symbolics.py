@@ -0,0 +1,46 @@
+from p65a import *
+from p65a.symbolics import COMPILE_THRESHOLD, Symbol, Literal, SymbolTable
+
+
+def deep(depth, name="x"):
+	expr = Symbol.make(name)
+	for i in range(depth):
+		expr = expr + Symbol.make(f"y{i % 3}") if i % 2 else expr * 1
+	return expr
+
+
+def test_key_is_structural():
+	x, y = Symbol.make("x"), Symbol.make("y")
+	assert (x + y * 2).key() == (x + y * 2).key()
+	assert (x + y * 2).key() != ((x + y) * 2).key()
+	assert (x + 1).key() != (x - 1).key()
+
+
+def test_deep_key():
+	a, b = deep(3000), deep(3000)
+	assert Dw(a).key() == Dw(b).key()
+	assert hash(Dw(a).key()) == hash(Dw(b).key())
+	assert Dw(a).key() != Dw(deep(3000, "z")).key()
+
+
+def test_deep_evaluate():
+	symbols = SymbolTable({"x": 1, "y0": 1, "y1": 2, "y2": 3})
+	assert deep(3000).evaluate(symbols) == 1 + sum(1 + i % 3 for i in range(3000) if i % 2)
+
+
+def test_compiled_only_when_reused():
+	x, y = Symbol.make("x"), Symbol.make("y")
+	expr = (x + y * 3 >> 1) - x
+	results = {expr.evaluate({"x": i, "y": 7}) for i in range(COMPILE_THRESHOLD)}
+	assert expr._compiled is None
+	assert expr.evaluate({"x": 5, "y": 7}) == 8
+	assert expr._compiled is not None
+	assert results == {(i + 21 >> 1) - i for i in range(COMPILE_THRESHOLD)}
+
+
+def test_deep_compiled_matches_walk():
+	symbols = {"x": 1, "y0": 1, "y1": 2, "y2": 3}
+	expr = deep(3000)
+	expected = expr.walk(symbols)
+	assert expr.compile()(symbols) == expected
+	assert expr.evaluate(symbols) == expected